@@ -46,6 +46,7 @@ import psutil
 #from scanlog.scanlog import process_logfile_list
 
 from quchemreport.parser.scanlog import process_logfile_list
+from quchemreport.parser import parse_cache
 from quchemreport.parser import conformity
 from quchemreport.visualization import visualization, latex_report, docx_report
 from quchemreport.config.config import Config
@@ -128,7 +129,15 @@ print("\nParsing input files...")
 paths = [log['path'] for log in config.logfiles]
 job_types = [[t.upper() for t in logfile["type"]] for logfile in config["logfiles"]]
 
-lf, jf = process_logfile_list(paths, log_storage_path=tmpdirname, verbose=verbose, sparse=False)
+cache = parse_cache.from_config(config)
+if verbose and cache is not None:
+    print('Using the parse cache in', cache.path)
+
+# MO coefficients and basis set as binary files in temp/wfn instead of the JSON
+sidecar_path = os.path.join("temp", "wfn") if config.options.get("wavefunction_sidecar", False) else None
+
+lf, jf = process_logfile_list(paths, log_storage_path=tmpdirname, verbose=verbose, sparse=False,
+                              nproc=config.resources.nproc, cache=cache, sidecar_path=sidecar_path)
 
 # checking that jf is not empty before any processing.
 tmpdirname = tempfile.mkdtemp()
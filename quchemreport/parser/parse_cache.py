@@ -0,0 +1,118 @@
+## -*- encoding: utf-8 -*-
+
+## Persistent cache of the scanlog reports.
+# A parsed step is stored as a zlib compressed pickle of the full_report dict.
+# The key is the hash of the log content, the scanlog version and the sparse flag,
+# so that any change of the log file or of the parser leads to a new parse.
+
+import os
+import zlib
+import pickle
+import hashlib
+
+class ParseCache:
+    u"""On-disk cache of the dicts built by scanlog.logfile_to_dict.
+
+    **Parameters:**
+      path : str
+    Directory of the cache entries (created if needed).
+      max_size : int|float
+    Maximal size of the cache in MB. The least recently used entries are evicted above.
+    """
+
+    suffix = ".pkl.z"
+
+    def __init__(self, path, max_size=512):
+        self.path = os.path.expanduser(path)
+        self.max_size = int(max_size * 1e6)
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, logfile, version, sparse):
+        u"""Returns the key of a log file (path or scanlog.LogStep) for a given parser version and sparse flag."""
+        h = hashlib.sha256()
+        opener = getattr(logfile, "open", None)
+        with (opener(binary=True) if opener is not None else open(logfile, "rb")) as log_fd:
+            for chunk in iter(lambda: log_fd.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(("|%s|%s" % (version, sparse)).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        u"""Returns the cached dict for key, or None if there is no valid entry."""
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as fd:
+                res_json = pickle.loads(zlib.decompress(fd.read()))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # corrupted or incompatible entry
+            self._remove(entry)
+            return None
+        # mtime is the LRU clock
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return res_json
+
+    def put(self, key, res_json):
+        u"""Stores res_json for key and evicts the oldest entries if the cache is too big."""
+        entry = self._entry(key)
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        with open(tmp, "wb") as fd:
+            fd.write(zlib.compress(pickle.dumps(res_json, protocol=pickle.HIGHEST_PROTOCOL)))
+        # atomic for the concurrent parsing workers
+        os.replace(tmp, entry)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for fname in os.listdir(self.path):
+            if fname.endswith(self.suffix):
+                fpath = os.path.join(self.path, fname)
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fpath))
+        return entries
+
+    def evict(self):
+        u"""Removes the least recently used entries until the cache fits in max_size."""
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, fpath in entries:
+            if total <= self.max_size:
+                break
+            self._remove(fpath)
+            total -= size
+
+    def clear(self):
+        u"""Removes all the entries of the cache."""
+        for mtime, size, fpath in self._entries():
+            self._remove(fpath)
+
+    @staticmethod
+    def _remove(fpath):
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+
+def from_config(config):
+    u"""Returns the ParseCache described by options.parse_cache in the configuration, or None if disabled."""
+    cache_config = config.options.get("parse_cache", None)
+    if cache_config is None:
+        return None
+    enabled, clear = cache_config.get("enabled", False), cache_config.get("clear", False)
+    if not (enabled or clear):
+        return None
+    cache = ParseCache(cache_config.get("path", "~/.cache/quchemreport"),
+                       max_size=cache_config.get("max_size", 512))
+    if clear:
+        cache.clear()
+    return cache if enabled else None
@@ -1,42 +1,74 @@
+import io
 import os
 import sys
 import json
+import time
 import pickle
 import hashlib
+import itertools
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 import cclib
+from cclib.io.ccio import guess_filetype
+from cclib.parser.data import ccData
+from cclib.bridge import makeopenbabel
 import openbabel.pybel as pybel
 import numpy as np
 import openbabel as ob
 import scipy.sparse as sp
 import sklearn.preprocessing
 
+from quchemreport.parser import sidecar as wfn_sidecar
+
 # constants
 CstBohr2Ang = 0.52917721092
 CstHartree2eV = 27.21138505
 CstHartree2cm1 = 219474.6313708
 scanlog_version = "1.0.2"
+# number of lines read to detect the solver
+SNIFF_LINES = 1000
 
 """ Scanlog Exception class.
 """
 class ScanlogException(Exception):
     pass
 
-"""Redefining nuclear_repulsion_energy with 5 decimals of precision on coords.
+"""Nuclear repulsion energy of a geometry (coordinates rounded to 5 decimals as in the log).
+Pair terms are computed one row at a time and added one by one in the (i, j) order
+of the pair loop, so that the result is the same to the last bit as the pair by pair sum.
 """
 def nuclear_repulsion_energy(data, slice_id=-1):
+    coords = np.asarray(data.atomcoords[slice_id])
+    r = np.array([float("%.5f" % k) for k in coords.flat]).reshape(coords.shape)
+    z = np.asarray(data.atomnos)
     nre = 0.0
-    for i in range(data.natom):
-        ri = np.array([float("%.5f" % k) for k in data.atomcoords[slice_id][i]])
-        zi = data.atomnos[i]
-        for j in range(i + 1, data.natom):
-            rj = np.array([float("%.5f" % k) for k in data.atomcoords[slice_id][j]])
-            zj = data.atomnos[j]
-            d = np.linalg.norm(ri - rj)
-            nre += zi * zj / d
+    for i in range(data.natom - 1):
+        diff = r[i] - r[i + 1:]
+        # stacked dot products, same rounding as np.linalg.norm on each pair
+        d = np.sqrt(np.matmul(diff[:, None, :], diff[:, :, None])[:, 0, 0])
+        for term in z[i] * z[i + 1:] / d:
+            nre += term
     return float("%.5f" % (nre * CstBohr2Ang))
 
+"""Converts cclib values to the types obtained after a JSON round trip
+(numpy arrays to lists with NaN as None, tuples to lists, keys to str).
+"""
+def _to_builtin(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.ndim == 0:
+            return _to_builtin(obj.item())
+        if obj.ndim == 1:
+            return [None if isinstance(x, float) and np.isnan(x) else x for x in obj.tolist()]
+        return [_to_builtin(a) for a in obj]
+    if isinstance(obj, (list, tuple)):
+        return [_to_builtin(x) for x in obj]
+    if isinstance(obj, dict):
+        return {str(k): _to_builtin(v) for k, v in obj.items()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
 """Utility function to simplify data recording from dict or other object.
 """
 def _try_key_insertion(res_json, key, obj, obj_path=[], nullable=True):
@@ -44,10 +76,10 @@ def _try_key_insertion(res_json, key, obj, obj_path=[], nullable=True):
     if obj.__class__ == dict :
         try:
             if obj_path:
-                d = obj.copy()
+                d = obj
                 for k in obj_path:
                     d = d[k]
-                res_json[key] = d
+                res_json[key] = _to_builtin(d)
         except Exception as e:
             if not nullable:
                 raise ScanlogException("Fatal : error occured for required key %s" % key)
@@ -58,8 +90,43 @@ def _try_key_insertion(res_json, key, obj, obj_path=[], nullable=True):
     elif not nullable:        
         raise ScanlogException("Fatal : key %s is N/A but is required" % key)
     # else obj is 'N/A' ans is ignored
-    
-def general_param_subsection(res_json, data_json, data, obdata):
+
+"""Nested dict of the ccData attributes with the CJSON paths of cclib (as data.writejson()),
+without the JSON serialization: numpy arrays are kept as references.
+Only the derived entries used by scanlog are added (formula with charge, total energy...).
+"""
+def ccdata_to_dict(data):
+    data_json = {}
+    for name, attr in ccData._attributes.items():
+        if not hasattr(data, name):
+            continue
+        path = attr.attribute_path.split(":")
+        if path[0] == "N/A":
+            continue
+        section = data_json.setdefault(path[0], {})
+        if name == "atomcoords":
+            section["coords"] = {"3d": data.atomcoords[-1].flatten()}
+            continue
+        if name == "moments":
+            # total dipole moment (center of mass only if 1 moment)
+            if len(data.moments) > 1:
+                data_json["properties"][attr.json_key] = np.linalg.norm(data.moments[1])
+            continue
+        for k in path[1:]:
+            section = section.setdefault(k, {})
+        section[attr.json_key] = getattr(data, name)
+    if hasattr(data, "moenergies") and hasattr(data, "homos") and hasattr(data, "scfenergies"):
+        data_json["properties"].setdefault("energy", {})["total"] = data.scfenergies[-1]
+    if hasattr(data, "atomnos"):
+        data_json["atoms"]["elements"]["atom count"] = len(data.atomnos)
+        data_json["atoms"]["elements"]["heavy atom count"] = len([x for x in data.atomnos if x > 1])
+    # formula with the charge as done by cclib with Open Babel
+    obmol = makeopenbabel(atomcoords=data.atomcoords, atomnos=data.atomnos,
+                          charge=getattr(data, "charge", 0), mult=getattr(data, "mult", 1))
+    data_json["formula"] = pybel.Molecule(obmol).formula
+    return data_json
+
+def general_param_subsection(res_json, data_json, data, obdata, sidecar_path=None):
     res_json["comp_details"]["general"] = {}
     section = res_json["comp_details"]["general"]
 
@@ -97,7 +164,12 @@ def general_param_subsection(res_json, data_json, data, obdata):
     try:
         basis_str = pickle.dumps(data.gbasis, protocol=0)
         basis_hash = hashlib.md5(basis_str).hexdigest()
-        _try_key_insertion(section, "basis_set", basis_str.decode())#"%s"  % basis_str[2:-1])
+        if sidecar_path is None:
+            _try_key_insertion(section, "basis_set", basis_str.decode())#"%s"  % basis_str[2:-1])
+        else:
+            # binary basis in the sidecar, the md5 identifies the basis in the JSON
+            _try_key_insertion(section, "basis_set", basis_hash)
+            _try_key_insertion(section, "basis_set_sidecar", wfn_sidecar.save_basis(sidecar_path, data.gbasis))
         _try_key_insertion(section, "basis_set_md5", basis_hash)
     except:
         pass
@@ -133,7 +205,7 @@ def td_param_subsection(res_json, data_json, data, obdata):
     section = res_json["comp_details"]["excited_states"]
 
     et_states = data_json.get('transitions', {}).get('electronic transitions', None)
-    if et_states:
+    if et_states is not None and len(et_states) > 0:
         section["nb_et_states"] = len(et_states)
     ## TODO
     # res_json["comp_details"]["excited_states"]["TDA"] = 'N/A' # TODO : test Tamm Damcoff approx.
@@ -141,7 +213,7 @@ def td_param_subsection(res_json, data_json, data, obdata):
     # res_json["comp_details"]["excited_states"]["et_optimization"] = 'N/A' # boolean (if optimization of ES)
     # res_json["comp_details"]["excited_states"]["opt_root_number"] = 'N/A' # optimized ES number
 
-def wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=True):
+def wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=True, sidecar_path=None):
     res_json["results"]["wavefunction"] = {}
     section = res_json["results"]["wavefunction"]
 
@@ -182,13 +254,23 @@ def wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=Tr
                 # zeroing
                 a[az[0], a_argsort[az]] = 0.
                 a = a[:b_cut, :]
+                if sidecar_path is not None:
+                    mo_coefs.append(a)
+                    continue
                 # to sparse csr matrix
                 acsr = sp.csr_matrix(a)
                 # append tuple for the csr to mo_coefs
                 mo_coefs.append( (acsr.data.tolist(), acsr.indices.tolist(), acsr.indptr.tolist()) )
+        elif sidecar_path is not None:
+            mo_coefs = [a[:b_cut, :] for a in data.mocoeffs[nb_coef:]]
         else:
             for a in data.mocoeffs[nb_coef:]:
                 mo_coefs.append(a.tolist())
+        if sidecar_path is not None:
+            # pruned dense matrices in .npy files, only the references in the JSON
+            mo_coefs = [{"coefs": wfn_sidecar.save_array(sidecar_path, "mo_coefs", a),
+                         "energies": wfn_sidecar.save_array(sidecar_path, "mo_energies", np.asarray(moen, dtype=np.float64))}
+                        for a, moen in zip(mo_coefs, section["MO_energies"][nb_coef:])]
         # data insertion into JSON
         section["MO_coefs"] = mo_coefs
     except Exception as e:
@@ -207,7 +289,7 @@ def wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=Tr
     except:
         pass # Dipolar moments not present depending on the verbosity of log. 
     try:
-        section["SCF_values"] = data_json['optimization']['scf']['values'][-1][-1] 
+        section["SCF_values"] = _to_builtin(data_json['optimization']['scf']['values'][-1][-1])
     except:
         pass
     _try_key_insertion(section, "virial_ratio", data_json, ['optimization', 'scf', 'virialratio'])
@@ -325,10 +407,10 @@ def molecule_section(res_json, data_json, data, obdata, verbose=False):
         pass #  SP ?
     _try_key_insertion(section, "starting_nuclear_repulsion", nuclear_repulsion_energy(data, 0))
 
-def parameters_section(res_json, data_json, data, obdata):
+def parameters_section(res_json, data_json, data, obdata, sidecar_path=None):
     res_json["comp_details"] = {}
     # subsection : General parameters
-    general_param_subsection(res_json, data_json, data, obdata)
+    general_param_subsection(res_json, data_json, data, obdata, sidecar_path=sidecar_path)
     # subsection : Geometry 
     geometry_param_subsection(res_json, data_json, data, obdata)
     # subsection : Thermochemistry and normal modes
@@ -336,10 +418,10 @@ def parameters_section(res_json, data_json, data, obdata):
     # subsection :  Excited states
     td_param_subsection(res_json, data_json, data, obdata)
 
-def results_section(res_json, data_json, data, obdata, sparse=True):
+def results_section(res_json, data_json, data, obdata, sparse=True, sidecar_path=None):
     res_json["results"] = {}
     # subsection : Wavefunction
-    wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=sparse)
+    wavefunction_results_subsection(res_json, data_json, data, obdata, sparse=sparse, sidecar_path=sidecar_path)
     # subsection : Geometry
     geom_results_subsection(res_json, data_json, data, obdata)
     # subsection : Thermochemistry and normal modes
@@ -353,26 +435,50 @@ def metadata_section(logfile, res_json, data_json, data, obdata):
     res_json["metadata"]["parser_version"] = scanlog_version
     res_json["metadata"]["log_file"] = os.path.basename(logfile)
 
-def full_report(logfile, data_json, data, obdata, verbose=False, sparse=True):
+def full_report(logfile, data_json, data, obdata, verbose=False, sparse=True, sidecar_path=None):
     res_json = {}
     # section : Molecule
     molecule_section(res_json, data_json, data, obdata, verbose=verbose)
     # section : Computational details
-    parameters_section(res_json, data_json, data, obdata)
+    parameters_section(res_json, data_json, data, obdata, sidecar_path=sidecar_path)
     # section : Results
-    results_section(res_json, data_json, data, obdata, sparse=sparse)
+    results_section(res_json, data_json, data, obdata, sparse=sparse, sidecar_path=sidecar_path)
     # section : Metadata
     metadata_section(logfile, res_json, data_json, data, obdata)
     return res_json
     
-def logfile_to_dict(logfile, verbose=False, sparse=True):
-    # reading with cclib
-    data = cclib.parser.ccopen(logfile).parse()
-    data_json = json.loads(data.writejson())
+def logfile_to_dict(logfile, verbose=False, sparse=True, cache=None, sidecar_path=None):
+    # parse cache (see parse_cache.ParseCache)
+    if cache is not None:
+        key = cache.key(logfile, scanlog_version + ("+sidecar" if sidecar_path is not None else ""), sparse)
+        res_json = cache.get(key)
+        # the sidecar files may have been removed since
+        if res_json is not None and all(os.path.isfile(f) for f in wfn_sidecar.files(res_json)):
+            if verbose:
+                print(">>> Parse cache hit for", logfile)
+            res_json["metadata"]["log_file"] = os.path.basename(str(logfile))
+            return res_json
+    # reading with cclib, a step is read through its view
+    log_name = logfile.name if isinstance(logfile, LogStep) else logfile
+    try:
+        if isinstance(logfile, LogStep):
+            with logfile.open() as log_fd:
+                data = cclib.parser.ccopen(log_fd).parse()
+        else:
+            data = cclib.parser.ccopen(logfile).parse()
+    except:
+        if verbose:
+            traceback.print_exc()
+        raise ScanlogException("LOG file not readable (cclib failed on file %s)." % log_name)
+    data_json = ccdata_to_dict(data)
     # openbabel sur XYZ
     obdata = pybel.readstring("xyz", data.writexyz())
     # construct new dict    
-    return full_report(logfile, data_json, data, obdata, verbose=verbose, sparse=sparse)
+    res_json = full_report(log_name, data_json, data, obdata, verbose=verbose, sparse=sparse,
+                           sidecar_path=sidecar_path)
+    if cache is not None:
+        cache.put(key, res_json)
+    return res_json
 
 
 def job_type_guess(res_json):
@@ -413,21 +519,133 @@ def job_type_guess(res_json):
             res_json["metadata"]["discretizable"] = "True"
     res_json["comp_details"]["general"]["job_type"] = job_type
 
-"""Verify that Logfile is readable by cclib and extract solver.
+"""Verify that Logfile is recognized by cclib and extract solver.
+Only the header is read (cclib trigger strings), the full parse is done once
+per step by logfile_to_dict.
 """
 def quality_check_lvl1(logfile, verbose=False):
     if verbose:
         print(">>> START QC lvl1 <<<")
     try:
-        # reading with cclib
-        data = cclib.parser.ccopen(logfile).parse()
-        if verbose:
-            print("OK\n>>> END QC lvl1 <<<\n")
+        with open(logfile, 'r', errors='replace') as log_fd:
+            filetype = guess_filetype(itertools.islice(log_fd, SNIFF_LINES))
     except:
+        filetype = None
+    if filetype is None:
         raise ScanlogException("Quality check lvl1 failed : LOG file not readable (cclib failed on file %s)." % logfile)
-    solver = data.metadata['package']
+    if verbose:
+        print("OK\n>>> END QC lvl1 <<<\n")
+    # cclib parser class names are the metadata['package'] values
+    solver = filetype.__name__
     return solver
 
+"""Step of a log file read through a seekable view.
+A step is a byte range [start, end) of the log file, preceded by a header
+which allows cclib to detect the solver. No file is written for the steps,
+name is only used for reporting (metadata log_file).
+"""
+class LogStep:
+    def __init__(self, path, start, end, header=b"", name=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.header = header
+        self.name = name if name is not None else path
+
+    def open(self, binary=False):
+        stream = io.BufferedReader(_LogStepView(self), buffer_size=1 << 20)
+        if binary:
+            return stream
+        return io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "LogStep(%r, %d, %d)" % (self.name, self.start, self.end)
+
+class _LogStepView(io.RawIOBase):
+    def __init__(self, step):
+        self.name = step.name
+        self._fd = open(step.path, "rb")
+        self._header = step.header
+        self._start = step.start
+        self._size = len(step.header) + step.end - step.start
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, b):
+        out = memoryview(b).cast("B")
+        n = min(len(out), self._size - self._pos)
+        if n <= 0:
+            return 0
+        done = 0
+        hlen = len(self._header)
+        if self._pos < hlen:
+            done = min(n, hlen - self._pos)
+            out[:done] = self._header[self._pos:self._pos + done]
+        if done < n:
+            self._fd.seek(self._start + self._pos + done - hlen)
+            done += self._fd.readinto(out[done:n])
+        self._pos += done
+        return done
+
+    def close(self):
+        self._fd.close()
+        super().close()
+
+"""Single pass on logfile, returns the steps ending with the term line.
+step_header(version) gives the header of a step, version being the last line
+containing version_tag before the beginning of the step.
+"""
+def _scan_steps(logfile, term, step_header, version_tag=None, log_storage_path="", verbose=False):
+    steps = []
+    base_fname = os.path.basename(logfile).rsplit('.', 1)[0]
+    log_pat = os.path.join(log_storage_path, "%s_step_%s.log" % (base_fname, "%d"))
+    version = b""
+    start = pos = 0
+    with open(logfile, "rb") as log_fd:
+        for line in log_fd:
+            if pos == start:
+                header = step_header(version)
+                if verbose:
+                    print(">>> Processing", log_pat % len(steps), "...")
+            if version_tag is not None and version_tag in line:
+                version = line
+            pos += len(line)
+            if term in line:
+                if verbose:
+                    print("=> ", line.decode(errors="replace"))
+                steps.append(LogStep(logfile, start, pos, header, log_pat % len(steps)))
+                start = pos
+    return steps
+
+def _gaussian_header(version):
+    return (b" Copyright (c) 1988,1990,1992,1993,1995,1998,2003,2009,2013,\n"
+            b"            Gaussian, Inc.  All Rights Reserved.\n")
+
+def _orca_header(version):
+    # software name and version at the beginning of each step
+    if version != b"":
+        return b"\nO   R   C   A\n" + b"\n" + version + b"\n"
+    return b"\nO   R   C   A\n"
+
 """Split Logfile.
 """
 def split_logfile(logfile, solver, log_storage_path="", verbose=False):
@@ -437,54 +655,18 @@ def split_logfile(logfile, solver, log_storage_path="", verbose=False):
         if verbose:
             print(">>> SOLVER:", solver)
         if solver == "Gaussian":
-            TERM = "Normal termination"
-
-            with open(logfile, 'r') as log_fd:
-                lines = log_fd.readlines()
-            nbl = len(lines)
-            
-            file_cnt = 0
-            base_fname = os.path.basename(logfile).rsplit('.', 1)[0]
-            log_pat = os.path.join(log_storage_path, "%s_step_%s.log" % (base_fname, "%d"))
-            cur_log = log_pat % file_cnt
-            if verbose:
-                print(">>> Processing", cur_log, "...")
-            cur_log_fd = open(cur_log, "w")
-            # FLAG to add copyright at the beginning of each step.
-            file_start = True
-
-            for cur_l, line in enumerate(lines):
-                if file_start:
-                    cur_log_fd.write(" Copyright (c) 1988,1990,1992,1993,1995,1998,2003,2009,2013,\n")
-                    cur_log_fd.write("            Gaussian, Inc.  All Rights Reserved.\n")
-                    file_start = False
-                    
-                cur_log_fd.write(line)
-                if line.find(TERM) > -1 :
-                    file_start = True
-                    if verbose:
-                        print("=> ",line)
-                    log_files.append(cur_log)
-                    cur_log_fd.close()
-                    file_cnt += 1
-                    if nbl > (cur_l + 1) :
-                        cur_log = log_pat % file_cnt
-                        if verbose:
-                            print(">>> Processing", cur_log, "...")
-                        cur_log_fd = open(cur_log, "w")
-            if not cur_log_fd.closed :
-                cur_log_fd.close()
+            log_files = _scan_steps(logfile, b"Normal termination", _gaussian_header,
+                                    log_storage_path=log_storage_path, verbose=verbose)
         elif solver == "GAMESS":
             ### TODO : GAMESS not tested, accepted here only for Riken
             ### DB insertion purpose (only OPT mono step)
-            TERM = "TERMINATED NORMALLY"
-            with open(logfile, 'r') as log_fd:
-                lines = log_fd.readlines()
-            for line in lines:
-                if line.find(TERM) > -1 :
-                    if verbose:
-                        print("=> ",line)
-                    log_files.append(logfile)
+            TERM = b"TERMINATED NORMALLY"
+            with open(logfile, 'rb') as log_fd:
+                for line in log_fd:
+                    if line.find(TERM) > -1 :
+                        if verbose:
+                            print("=> ", line.decode(errors="replace"))
+                        log_files.append(logfile)
             pass
         elif solver == "NWChem":
             ### TODO : NWChem not tested
@@ -492,53 +674,15 @@ def split_logfile(logfile, solver, log_storage_path="", verbose=False):
             log_files.append(logfile)
             pass
         elif solver == "ORCA":
-            TERM = "Timings for individual modules:"
-            program_version = ""
-            with open(logfile, 'r') as log_fd:
-                lines = log_fd.readlines()
-            nbl = len(lines)
-
-            file_cnt = 0
-            base_fname = os.path.basename(logfile).rsplit('.', 1)[0]
-            log_pat = os.path.join(log_storage_path, "%s_step_%s.log" % (base_fname, "%d"))
-            cur_log = log_pat % file_cnt
-            if verbose:
-                print(">>> Processing", cur_log, "...")
-            cur_log_fd = open(cur_log, "w")
-            # FLAG to add software name and version at the beginning of each step.
-            file_start = True
-
-            for cur_l, line in enumerate(lines):
-                if file_start:
-                    cur_log_fd.write("\nO   R   C   A\n")
-                    if program_version != "" :
-                        cur_log_fd.write("\n"+program_version+"\n")
-                    file_start = False
-
-                if "Program Version" in line:
-                    program_version = line
-
-                cur_log_fd.write(line)
-                if line.find(TERM) > -1 :
-                    file_start = True
-                    if verbose:
-                        print("=> ",line)
-                    log_files.append(cur_log)
-                    cur_log_fd.close()
-                    file_cnt += 1
-                    if nbl > (cur_l + 1) :
-                        cur_log = log_pat % file_cnt
-                        if verbose:
-                            print(">>> Processing", cur_log, "...")
-                        cur_log_fd = open(cur_log, "w")
-            if not cur_log_fd.closed :
-                cur_log_fd.close()
+            log_files = _scan_steps(logfile, b"Timings for individual modules:", _orca_header,
+                                    version_tag=b"Program Version",
+                                    log_storage_path=log_storage_path, verbose=verbose)
         else: # unsupported solvers
             raise ScanlogException("Unsupported solver (%s)." % solver)
             #log_files.append(logfile)
             
         if verbose:
-            print(">>> Steps :", log_files, "\n")
+            print(">>> Steps :", [str(log) for log in log_files], "\n")
         return log_files
     except ScanlogException as err:
         raise err
@@ -575,28 +719,103 @@ def quality_check_lvl2(res_json, solver, verbose=False):
         print("Archivable for new entry:", res_json['metadata']['archivable_for_new_entry'])
         print(">>> END QC lvl2 <<<\n")
 
-def process_logfile(logfile, log_storage_path="", verbose=False, sparse=True):
+def _process_step(log, solver, verbose=False, sparse=True, cache=None, sidecar_path=None):
+    t_start = time.time()
+    res_json = logfile_to_dict(log, verbose=verbose, sparse=sparse, cache=cache, sidecar_path=sidecar_path)
+    if verbose:
+        print(">>> %s parsed in %.2f s" % (log, time.time() - t_start))
+    job_type_guess(res_json)
+    quality_check_lvl2(res_json, solver, verbose=verbose)
+    return res_json
+
+def _split_job(logfile, log_storage_path="", verbose=False):
     solver = quality_check_lvl1(logfile, verbose=verbose)
     log_files = split_logfile(logfile, solver, log_storage_path=log_storage_path, verbose=verbose)
+    return solver, log_files
+
+def _report_failure(logfile, err, verbose=False):
+    sys.stderr.write("ERROR: %s could not be parsed (%s)\n" % (logfile, err))
+    if verbose:
+        traceback.print_exception(type(err), err, err.__traceback__)
+
+def _raise_failures(failures):
+    # one exception for all the files which could not be parsed (file, error), the first error being its cause
+    if len(failures) > 0:
+        raise ScanlogException("%d log file(s) could not be parsed: %s"
+                               % (len(failures), "; ".join("%s (%s)" % f for f in failures))) from failures[0][1]
+
+def process_logfile(logfile, log_storage_path="", verbose=False, sparse=True, cache=None, sidecar_path=None):
+    solver, log_files = _split_job(logfile, log_storage_path=log_storage_path, verbose=verbose)
     json_list = []
     for log in log_files:
-        res_json = logfile_to_dict(log, verbose=verbose, sparse=sparse)
-        job_type_guess(res_json)            
-        quality_check_lvl2(res_json, solver, verbose=verbose)
-        json_list.append(res_json)
+        json_list.append(_process_step(log, solver, verbose=verbose, sparse=sparse, cache=cache,
+                                       sidecar_path=sidecar_path))
+    return (log_files, json_list)
+
+"""Parallel version of process_logfile_list.
+Log files are split in a first pass, then every step is parsed by the pool.
+Results keep the input order. As in the sequential version, every file and step is
+parsed, the failures are reported one by one, then a single ScanlogException lists them
+(the job types of the config are given by position of the files: no result is returned).
+"""
+def _process_logfile_list_parallel(logfilelist, log_storage_path="", verbose=False, sparse=True, nproc=2,
+                                   cache=None, sidecar_path=None):
+    json_list = []
+    log_files = []
+
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        # QC lvl1 and splitting of every log file
+        split_jobs = [pool.submit(_split_job, logfile, log_storage_path, verbose)
+                      for logfile in logfilelist]
+        steps = []
+        failures = []
+        for logfile, job in zip(logfilelist, split_jobs):
+            try:
+                solver, l = job.result()
+            except Exception as err:
+                _report_failure(logfile, err, verbose=verbose)
+                failures.append((logfile, err))
+                continue
+            steps += [(log, solver) for log in l]
+        # parsing of every step
+        step_jobs = [pool.submit(_process_step, log, solver, verbose, sparse, cache, sidecar_path)
+                     for log, solver in steps]
+        for (log, solver), job in zip(steps, step_jobs):
+            try:
+                res_json = job.result()
+            except Exception as err:
+                _report_failure(log, err, verbose=verbose)
+                failures.append((log, err))
+                continue
+            json_list.append(res_json)
+            log_files.append(log)
+
+    _raise_failures(failures)
     return (log_files, json_list)
 
-def process_logfile_list(logfilelist, log_storage_path="", verbose=False, sparse=True):
+def process_logfile_list(logfilelist, log_storage_path="", verbose=False, sparse=True, nproc=1, cache=None,
+                         sidecar_path=None):
+    if nproc is not None and nproc > 1 and len(logfilelist) > 0:
+        return _process_logfile_list_parallel(logfilelist, log_storage_path=log_storage_path,
+                                              verbose=verbose, sparse=sparse, nproc=nproc,
+                                              cache=cache, sidecar_path=sidecar_path)
     json_list = []
     log_files = []
+    failures = []
 
     for logfile in logfilelist:
-        l, j = process_logfile(logfile, 
-                               log_storage_path=log_storage_path,
-                               verbose=verbose, sparse=sparse)
+        try:
+            l, j = process_logfile(logfile, 
+                                   log_storage_path=log_storage_path,
+                                   verbose=verbose, sparse=sparse, cache=cache, sidecar_path=sidecar_path)
+        except Exception as err:
+            _report_failure(logfile, err, verbose=verbose)
+            failures.append((logfile, err))
+            continue
         json_list += j
         log_files += l
         
+    _raise_failures(failures)
     return (log_files, json_list)
 
 if __name__ == "__main__" :
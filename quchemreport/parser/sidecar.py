@@ -0,0 +1,69 @@
+## -*- encoding: utf-8 -*-
+
+## Binary sidecar files for the wavefunction data of scanlog.
+# MO coefficients and energies are stored as .npy files (memory-mappable),
+# the basis set as flat arrays in a .npz file. The JSON only keeps references.
+# Files are named by the hash of their content, so a file is never rewritten
+# and can be shared between steps, runs and the parse cache.
+# The references are paths relative to the directory of the JSON (base): the run
+# directory for the JSON in memory, so that the JSON and temp/ can be moved together.
+
+import os
+import hashlib
+import numpy as np
+
+def _save(sidecar_path, prefix, ext, content, write, base):
+    digest = hashlib.sha1(content).hexdigest()[:20]
+    fname = os.path.join(sidecar_path, "%s_%s%s" % (prefix, digest, ext))
+    if not os.path.isfile(fname):
+        os.makedirs(sidecar_path, exist_ok=True)
+        tmp = "%s.%d.tmp%s" % (fname[:-len(ext)], os.getpid(), ext)
+        write(tmp)
+        os.replace(tmp, fname)
+    return os.path.relpath(fname, base)
+
+def _path(fname, base):
+    # absolute references (older JSON) are kept as they are
+    return os.path.join(base, fname)
+
+def save_array(sidecar_path, prefix, a, base=os.curdir):
+    u"""Saves a numpy array as a .npy file and returns its path relative to base."""
+    a = np.ascontiguousarray(a)
+    content = ("%s%s" % (a.dtype.str, a.shape)).encode() + a.tobytes()
+    return _save(sidecar_path, prefix, ".npy", content, lambda f: np.save(f, a), base)
+
+def load_array(fname, base=os.curdir):
+    u"""Loads a .npy sidecar file (path relative to base) without copy (memory-mapped)."""
+    return np.load(_path(fname, base), mmap_mode="r")
+
+def save_basis(sidecar_path, gbasis, base=os.curdir):
+    u"""Saves a cclib gbasis (list per atom of (type, [(exponent, coefficient), ...]) shells) and returns the path relative to base."""
+    shells = [(ii, shell[0], shell[1]) for ii, atom in enumerate(gbasis) for shell in atom]
+    arrays = {"atom": np.array([s[0] for s in shells], dtype=np.int32),
+              "type": np.array([str(s[1]) for s in shells]),
+              "pnum": np.array([len(s[2]) for s in shells], dtype=np.int32),
+              "prims": np.array([p[:2] for s in shells for p in s[2]], dtype=np.float64).reshape((-1, 2))}
+    content = b"".join(arrays[k].tobytes() for k in sorted(arrays))
+    return _save(sidecar_path, "basis", ".npz", content, lambda f: np.savez(f, **arrays), base)
+
+def load_basis(fname, base=os.curdir):
+    u"""Returns the basis of a sidecar file (path relative to base) with the gbasis layout (primitives as (pnum, 2) arrays)."""
+    with np.load(_path(fname, base), allow_pickle=False) as f:
+        atom, types, pnum, prims = f["atom"], f["type"], f["pnum"], f["prims"]
+    gbasis = [[] for i in range(int(atom.max()) + 1 if len(atom) > 0 else 0)]
+    bounds = np.concatenate(([0], np.cumsum(pnum)))
+    for i in range(len(atom)):
+        gbasis[atom[i]].append((str(types[i]), prims[bounds[i]:bounds[i + 1]]))
+    return gbasis
+
+def files(res_json, base=os.curdir):
+    u"""Returns the list of sidecar files referenced by a scanlog dict, with base the directory of the JSON."""
+    refs = []
+    basis = res_json.get("comp_details", {}).get("general", {}).get("basis_set_sidecar")
+    if basis is not None:
+        refs.append(basis)
+    mo_coefs = res_json.get("results", {}).get("wavefunction", {}).get("MO_coefs", [])
+    for ref in mo_coefs:
+        if isinstance(ref, dict):
+            refs += list(ref.values())
+    return [_path(ref, base) for ref in refs]
@@ -16,29 +16,49 @@
 import math 
 import numpy as np
 
-def GaussianSpectrum(start,end,numpts,et_energies,heights,FWHM):
-# Calculate the absorption spectra with a gaussian broadening. Adapted from the GaussSum program
-# et_energies is a list of excited states energies in cm-1
-# et_oscs is a list of oscillator strength
+# Chunk of x values so that the (peaks x points) profile block stays below ~32 MB
+chunk_bytes = 32e6
 
-    peaks = et_energies
-    xvalues = np.arange(numpts)*float(end-start)/(numpts-1) + start
-    data = []
+def _profile(dx, FWHM, lineshape="gaussian", eta=0.5):
+# Band profile for the distances dx to the peak positions.
+# Every line shape has the same FWHM and the area of the gaussian of height 1,
+# so that heights computed for the gaussian broadening keep the intensities.
     A = -2.7726/FWHM**2
-    for x in xvalues:
-        tot = [0]*len(heights) # Sum of each gaussian bands for this x value
-
-        for peakno in range(len(peaks)): # For each peak
-            pos = peaks[peakno]
-            exponent = math.exp(A*(pos-x)**2)
-            for spectrumno in range(len(heights)):
-                tot[spectrumno] += heights[spectrumno][peakno]*exponent
+    if lineshape == "gaussian":
+        return np.exp(A*dx**2)
+    # area of the gaussian of height 1 / area of the lorentzian of height 1
+    lorentz = (2*math.sqrt(math.pi/2.7726)/math.pi) / (1 + 4*dx**2/FWHM**2)
+    if lineshape == "lorentzian":
+        return lorentz
+    if lineshape == "voigt":
+        # pseudo-Voigt : eta lorentzian + (1 - eta) gaussian
+        return eta*lorentz + (1 - eta)*np.exp(A*dx**2)
+    raise ValueError("Unknown line shape %s (gaussian, lorentzian or voigt)" % lineshape)
 
-        data.append(tot)
+def Spectrum(start,end,numpts,et_energies,heights,FWHM,lineshape="gaussian",eta=0.5):
+# Calculate the absorption spectra with a gaussian, lorentzian or pseudo-Voigt broadening.
+# et_energies is a list of excited states energies in cm-1
+# heights is a list of spectra, each a list of band heights (one per excited state)
+# The bands are summed peak after peak (reduction along the first axis),
+# as in the original loop of GaussSum.
 
-    spectrum = np.swapaxes(np.array(data),0,1)
+    peaks = np.asarray(et_energies, dtype=float)
+    heights = np.asarray(heights, dtype=float).reshape((-1, len(peaks)))
+    xvalues = np.arange(numpts)*float(end-start)/(numpts-1) + start
+    spectrum = np.zeros((len(heights), numpts))
+    step = max(1, int(chunk_bytes // (8*max(1, len(peaks)))))
+    for i in range(0, numpts, step):
+        profile = _profile(peaks[:, None] - xvalues[None, i:i+step], FWHM, lineshape, eta)
+        for spectrumno in range(len(heights)):
+            spectrum[spectrumno, i:i+step] = (heights[spectrumno][:, None]*profile).sum(axis=0)
     return xvalues, spectrum
 
+def GaussianSpectrum(start,end,numpts,et_energies,heights,FWHM):
+# Calculate the absorption spectra with a gaussian broadening. Adapted from the GaussSum program
+# et_energies is a list of excited states energies in cm-1
+# et_oscs is a list of oscillator strength
+    return Spectrum(start,end,numpts,et_energies,heights,FWHM,lineshape="gaussian")
+
 def CDheights(et_energies, et_rotats, FWHM):
     # Equation 8 in Stephens, Harada, Chirality, 2010, 22, 229.
     # This uses Delta, the half width at 1/e height.
@@ -4,15 +4,77 @@
 ## Functions for calculating molecular orbitals and electron density differences.
 
 from quchemreport.utils.units import A_to_a0, ea0_to_D, pm_to_a0, Eh_to_eV, eA_to_D
-from quchemreport.utils.parameters import obk_step
+from quchemreport.utils.parameters import obk_step, obk_extand, obk_max_step, obk_min_extand, obk_max_voxels, \
+                                          mo_cache_fraction
 from orbkit import core
+from orbkit.orbitals import MOClass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import copy
+import shutil
+import hashlib
 import numpy as np
+from scipy import ndimage
 
 ## Patched version of orbkit.read to read a json
 from quchemreport.processing import json2orbkit
+from quchemreport.processing import sparse_grid
+from quchemreport.processing import poisson
+from quchemreport.processing.grid_store import GridStore
+
+## Grid descriptor
+class Grid:
+    u"""Regular grid of the voxels, described by its origin, spacing and shape.
+
+    The coordinates are not stored: they are generated as 1-D axes (or broadcastable
+    sparse meshgrids) when needed. Coordinates are those of numpy.mgrid, i.e. origin + i*spacing.
+
+    ** Parameters **
+      origin : array-like
+    Coordinates of the first voxel (x, y, z).
+      spacing : array-like
+    Voxel size along x, y and z.
+      shape : tuple(int)
+    Number of voxels along x, y and z.
+    """
+
+    def __init__(self, origin, spacing, shape):
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = np.asarray(spacing, dtype=float)
+        self.shape = tuple(int(n) for n in shape)
+
+    @property
+    def axes(self):
+        u"""Coordinates along x, y and z (1-D arrays)."""
+        return tuple(np.arange(n)*d + o for o, d, n in zip(self.origin, self.spacing, self.shape))
+
+    @property
+    def d3r(self):
+        u"""Element of volume."""
+        return float(np.prod(self.spacing))
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def mesh(self):
+        u"""Returns broadcastable X, Y, Z meshgrids of shapes (nx,1,1), (1,ny,1) and (1,1,nz)."""
+        return np.meshgrid(*self.axes, indexing="ij", sparse=True)
+
+    def __repr__(self):
+        return "Grid(origin=%s, spacing=%s, shape=%s)" % (self.origin.tolist(), self.spacing.tolist(), self.shape)
+
+def _grid_bounds(geo_spec, over_s=obk_extand):
+    u"""Returns the lower and upper corners of the grid around the atoms of geo_spec, padded by over_s (Bohr)."""
+    return np.around(np.amin(geo_spec, axis=0) - over_s), np.around(np.amax(geo_spec, axis=0) + over_s)
+
+def _grid_shape(lower, upper, grid_step):
+    u"""Number of voxels along x, y and z of a grid (as numpy.arange(lower, upper + grid_step, grid_step))."""
+    return [int(np.ceil((upper[i] + grid_step - lower[i])/grid_step)) for i in range(3)]
 
 ## Get grid parameters and initialize grid
-def _init_ORB_grid(data, grid_step=obk_step, over_s=5):
+def _init_ORB_grid(data, grid_step=obk_step, over_s=obk_extand):
     u"""Initializes ORBKIT's grid and returns necessary data for visualization.
 
     **Parameters:**
@@ -20,12 +82,12 @@ def _init_ORB_grid(data, grid_step=obk_step, over_s=5):
     QCinfo instance representing the molecule.
       grid_step : float
     Parameter controlling grid voxel size in atomic units on one dimension. Cubic voxels are used
-      over_s : int|float
-    Oversizing, to be tuned
+      over_s : int|float, optional
+    Oversizing in Bohr (Settings.grid_padding, see plan_grid)
 
     **Returns**
-      X, Y, Z
-    Meshgrid (as returned by numpy.mgrid) for positioning the voxels.
+      grid : Grid
+    Descriptor of the grid for positioning the voxels.
     """
 
     from orbkit import grid
@@ -36,56 +98,289 @@ def _init_ORB_grid(data, grid_step=obk_step, over_s=5):
     ## Spacing/Number of points
     grid.delta_ = [grid_step]*3
 
-    grid.max_ = np.around(np.amax(data.geo_spec, axis=0) + over_s)
-    grid.min_ = np.around(np.amin(data.geo_spec, axis=0) - over_s)
+    grid.min_, grid.max_ = _grid_bounds(data.geo_spec, over_s)
 
     grid.init(force=True)
 
-    ## The meshgrid MUST be generated in this manner,
+    ## The grid MUST be described in this manner,
     ## in order to be maximally consistent with ORBKIT
     ## which uses numpy.arange to generate its grid
-    ## (i.e. start:stop+step:step)
-    X, Y, Z = np.mgrid[grid.min_[0] : grid.max_[0] + grid.delta_[0] : grid.delta_[0],
-                       grid.min_[1] : grid.max_[1] + grid.delta_[1] : grid.delta_[1],
-                           grid.min_[2] : grid.max_[2] + grid.delta_[2] : grid.delta_[2]]
+    ## (i.e. start:stop+step:step, as numpy.mgrid)
+    shape = _grid_shape(grid.min_, grid.max_, grid_step)
 
     ## NOTICE: numpy.arange does not return consistent results if step is a float,
     ## specifically if (stop - start)/step overflows, resulting in
     ## arange(start, stop, step)[-1] > stop
 
-    return X, Y, Z
+    return Grid(grid.min_, grid.delta_, shape)
 
-## Calculations
-def MO(j_data, MO_list, spin="none", grid_step=obk_step, nproc=4):
-    u"""Calculates the voxels representing the requested molecular orbitals of a molecule.
+## Cache of the discretized molecular orbitals
+class GridCache:
+    u"""In-process LRU cache of voxel grids, bounded in memory.
+
+    The same orbitals (HOMO, LUMO...) are needed by the MO pictures, the density
+    differences of every transition and the emission, on the same grid.
+
+    ** Parameters **
+      max_bytes : int|float
+    Maximal memory used by the cached grids. The least recently used grids are evicted above.
+    """
+
+    def __init__(self, max_bytes=2e9):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._grids = OrderedDict()
+
+    def get(self, key):
+        grid = self._grids.get(key, None)
+        if grid is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._grids.move_to_end(key)
+        return grid
+
+    def put(self, key, grid):
+        if key in self._grids or grid.nbytes > self.max_bytes:
+            return
+        # read only: the grids are shared between callers
+        (grid.data if isinstance(grid, sparse_grid.BlockGrid) else grid).flags.writeable = False
+        self._grids[key] = grid
+        self.nbytes += grid.nbytes
+        self.evict()
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self._grids) > 0:
+            key, grid = self._grids.popitem(last=False)
+            self.nbytes -= grid.nbytes
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self._grids.clear()
+        self.nbytes = 0
+
+## Number of voxel values (orbitals x voxels) squared at once in TD
+TD_block = 1 << 22
+
+## Edge of the blocks of voxels of the screened MOs
+screen_block = 16
+
+## Settings of the discretizations
+class Settings:
+    u"""Settings of the discretizations of a run, passed to MO, TD, Potential and Fukui.
+
+    The default values are those of a run without configuration (see from_config).
+
+    ** Parameters **
+      grid_store : grid_store.GridStore, optional
+    On-disk store of the grids. None if disabled.
+      grid_dtype : numpy.dtype, optional
+    Floating point type of the discretized MOs, density differences and Fukui functions.
+    Charges, barycenters and lambda are always summed in float64.
+      screen_threshold : float, optional
+    If not None, the MOs are only evaluated on the blocks of screen_block**3 voxels where they may be larger
+    than screen_threshold (a.u.).
+      out_of_core : str, optional
+    TD slab by slab: "auto" (if the grids would exceed max_bytes), "always" or "never".
+      max_bytes : int|float, optional
+    Memory budget of the discretizations, in bytes.
+      mep_mode : str, optional
+    Electrostatic potential: "volume" (V on every voxel) or "surface" (V only at the points of the density
+    isosurface, see SurfacePotential).
+      mep_coarsening : int, optional
+    In surface mode, the Poisson equation is solved on a grid coarser by mep_coarsening.
+      grid_padding : float, optional
+    Padding of the grid around the molecule in Bohr (see plan_grid).
+      mo_cache : GridCache, optional
+    Cache of the discretized MOs, shared by MO, TD and the emission (a new cache by default).
+    """
+
+    def __init__(self, grid_store=None, grid_dtype=np.float64, screen_threshold=None, out_of_core="auto",
+                 max_bytes=None, mep_mode="volume", mep_coarsening=2, grid_padding=obk_extand, mo_cache=None):
+        self.grid_store = grid_store
+        self.grid_dtype = grid_dtype
+        self.screen_threshold = screen_threshold
+        self.out_of_core = out_of_core
+        self.max_bytes = max_bytes
+        self.mep_mode = mep_mode
+        self.mep_coarsening = mep_coarsening
+        self.grid_padding = grid_padding
+        self.mo_cache = mo_cache if mo_cache is not None else GridCache()
+
+    @classmethod
+    def from_config(cls, config):
+        u"""Returns the settings of the resources and options sections of the configuration.
+
+        resources.memory is shared between the MO cache (mo_cache_fraction) and the discretizations.
+        """
+        max_bytes = config.resources.memory * 1e+9
+        grid_store = None
+        # the discretized grids are saved in temp/grids and reloaded on restart
+        if config.options.get("grid_store", False):
+            grid_store = GridStore(os.path.join("temp", "grids"), read=(config.options.restart == 1),
+                                   max_size=config.options.get("grid_store_size", 4096))
+        return cls(grid_store=grid_store,
+                   # single precision grids for the MOs, density differences and Fukui functions
+                   grid_dtype=np.float32 if config.resources.get("precision", "double") == "single" else np.float64,
+                   screen_threshold=config.resources.get("grid_screening", None),
+                   out_of_core=config.resources.get("out_of_core", "auto"),
+                   max_bytes=max_bytes*(1 - mo_cache_fraction),
+                   mep_mode=config.resources.get("mep", "volume"),
+                   mo_cache=GridCache(max_bytes*mo_cache_fraction))
+
+    def replace(self, **changes):
+        u"""Returns a copy of the settings with the given changes, sharing the MO cache."""
+        settings = copy.copy(self)
+        for name, value in changes.items():
+            setattr(settings, name, value)
+        return settings
+
+def _screening(settings):
+    return None if settings.screen_threshold is None else (float(settings.screen_threshold), screen_block)
+
+def _wfn_hash(j_data, qc):
+    u"""Returns a hash identifying the wavefunction (basis set, geometry and MO coefficients) of a QCinfo instance."""
+    h = hashlib.sha1()
+    h.update(str(j_data['comp_details']['general'].get('basis_set_md5', '')).encode())
+    h.update(np.ascontiguousarray(qc.geo_spec, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(qc.mo_spec.get_coeffs(), dtype=float).tobytes())
+    return h.hexdigest()
+
+def _grid_spec(data, grid_step=obk_step, over_s=obk_extand):
+    u"""Returns the parameters (min, max, delta) of the grid initialized by _init_ORB_grid for a QCinfo instance."""
+    return tuple(np.concatenate(_grid_bounds(data.geo_spec, over_s) + ([grid_step]*3,)).tolist())
+
+def _input_key(settings, j_data, qc, kind, extra=None, grid_step=obk_step):
+    if kind == "MEP" and settings.mep_mode == "surface":
+        extra = (extra, settings.mep_mode, settings.mep_coarsening)
+    return GridStore.key(kind, _wfn_hash(j_data, qc), _grid_spec(qc, grid_step, settings.grid_padding),
+                         np.dtype(settings.grid_dtype).str, _screening(settings), extra)
+
+def input_key(j_data, kind, extra=None, grid_step=obk_step, settings=None):
+    u"""Returns the key of the inputs of a discretization in the grid store of settings, or None without grid store.
 
     ** Parameters **
       j_data : dict
     Data on the molecule, deserialized from the scanlog format.
-      MO_list : list(str) or list(int)
-    A list containing either:
-      - integers designating the molecular orbitals (starting from 1)
-      - strings designating the molecular orbitals either through:
-        - keywords (e.g. "homo", "lumo")
-        - ranges (e.g. "homo-1:lumo+2")
-        - symmetries (e.g. "5.A")
-      grid_step : int, optional
-    Governs the grid to be used for the voxels.
-      - If positive, it indicates the number of points in all 3 dimensions.
-      - If zero, it indicates the default number of points (80).
-      - If negative, it indicates the resolution, in (A.U.)^-1.
+      kind : str
+    Type of discretization ("MO", "TD", "MEP"...).
+      extra : list, optional
+    Other inputs (orbitals, transitions...)
+      settings : Settings, optional
+    Settings of the discretization.
+    """
+    if settings is None or settings.grid_store is None:
+        return None
+    return _input_key(settings, j_data, json2orbkit.convert_json(j_data, all_mo=True), kind, extra, grid_step)
 
-    ** Returns **
-      out : list(numpy.ndarray)
-    List of numpy.ndarrays, each one containing the values of the probability amplitude of a single molecular orbital at each voxel of the grid.
-      X, Y, Z : numpy.ndarray
-    Meshgrids (as generated by numpy.mgrid) required for positioning the voxel values contained in out.
+## Grid planning
+def bytes_per_voxel(kind, n_mo=0, n_transitions=0, settings=None):
+    u"""Estimates the memory allocated at once by a discretization, in bytes per voxel of the grid.
+
+    ** Parameters **
+      kind : str
+    Type of discretization: "MO", "TD", "Fukui" or "MEP".
+      n_mo : int, optional
+    Number of discretized MOs (MO and TD).
+      n_transitions : int, optional
+    Number of transitions (TD).
+      settings : Settings, optional
+    Settings of the discretization (grid_dtype and mep_mode).
     """
+    if settings is None:
+        settings = Settings()
+    itemsize = np.dtype(settings.grid_dtype).itemsize
+    if kind == "MO":
+        return n_mo*itemsize
+    if kind == "TD":
+        # orbitals, density differences and overlaps of all the transitions, and scratch
+        return (n_mo + 2*n_transitions + 1)*itemsize
+    if kind == "Fukui":
+        # both densities computed by orbkit (float64), the difference and the one kept for the dual descriptor
+        return 2*8 + 2*itemsize
+    if kind == "MEP":
+        if settings.mep_mode == "surface":
+            # float64: rho, and the coarse density, potential and work arrays of the Poisson solver
+            # (with the padded grid of its boundary values)
+            return 2*8
+        # float64: rho, V_n, V, the work array of the Poisson solver and the grid of its boundary values
+        return 5*8
+    raise ValueError("Unknown discretization: %s" % kind)
+
+def plan_grid(j_data, voxel_bytes, max_bytes, grid_step=obk_step, over_s=obk_extand,
+              max_step=obk_max_step, min_over_s=obk_min_extand, max_voxels=obk_max_voxels):
+    u"""Chooses the grid spacing and padding of a molecule within a memory budget.
+
+    The finest spacing (grid_step) and the default padding (over_s) are kept if the grid fits.
+    Otherwise the spacing is increased by steps of 0.005 Bohr up to max_step, then the padding
+    is reduced by 0.5 Bohr down to min_over_s (and the spacings tried again), until the estimated
+    peak memory fits in max_bytes and the grid has at most max_voxels voxels.
 
-    ## Prepare data for ORBKIT
-    qc = json2orbkit.convert_json(j_data, all_mo=True)
-    X, Y, Z = _init_ORB_grid(qc, grid_step=grid_step)
+    ** Parameters **
+      j_data : dict
+    Data on the molecule, as deserialized from the scanlog format.
+      voxel_bytes : int|float
+    Memory allocated at once per voxel (see bytes_per_voxel), for the most demanding discretization.
+      max_bytes : int|float
+    Memory budget of the discretization.
 
+    ** Returns **
+      plan : dict
+    step (Bohr), padding (Bohr), shape of the grid, peak (estimated peak memory, in bytes) and fits (False if the
+    budget could not be met with max_step and min_over_s).
+    """
+    geo_spec = json2orbkit.convert_json(j_data).geo_spec
+    def plan(step, pad):
+        shape = _grid_shape(*_grid_bounds(geo_spec, pad), step)
+        nvox = int(np.prod(shape))
+        return {"step": step, "padding": pad, "shape": shape, "peak": nvox*voxel_bytes,
+                "fits": nvox*voxel_bytes <= max_bytes and nvox <= max_voxels}
+    steps = np.round(np.arange(grid_step, max_step + 1e-9, 0.005), 4).tolist() or [grid_step]
+    pads = np.arange(over_s, min_over_s - 1e-9, -0.5).tolist() or [over_s]
+    for pad in pads:
+        for step in steps:
+            res = plan(step, pad)
+            if res["fits"]:
+                return res
+    return res
+
+def _screened_MOs(qc, grid, settings, nproc=4):
+    u"""Discretizes the MOs of qc on the blocks of the grid where they may pass settings.screen_threshold.
+
+    The MOs are evaluated at once (the basis functions are shared) on the union of their blocks,
+    and each MO keeps only its own blocks.
+
+    ** Returns **
+      out : list(sparse_grid.BlockGrid)
+    """
+    from orbkit import grid as obk_grid
+    significant = sparse_grid.significant_blocks(qc, grid, screen_block, settings.screen_threshold)
+    union = np.flatnonzero(significant.any(axis=0))
+    index = np.array(np.unravel_index(union, sparse_grid.block_counts(grid, screen_block))).T.reshape((-1, 3))
+    blocks = np.zeros((len(union), screen_block**3), dtype=settings.grid_dtype)
+    if len(union) > 0:
+        (x, y, z), mask = sparse_grid.block_points(grid, screen_block, index)
+        # orbkit evaluates the MOs on the vector of points of the blocks
+        obk_grid.set_grid(x, y, z, is_vector=True)
+        values = core.rho_compute(qc, calc_mo=True, numproc=nproc)
+    out = []
+    for k in range(len(qc.mo_spec)):
+        keep = significant[k, union]
+        if len(union) > 0:
+            blocks[mask] = values[k]
+        data = blocks[keep].reshape((-1,) + (screen_block,)*3)
+        out.append(sparse_grid.BlockGrid(grid, screen_block, index[keep], data))
+    print("Screened MOs: %.1f%% of the voxels evaluated, %.1f%% stored" %
+          (100.0*len(union)/significant.shape[1], 100.0*significant.mean()))
+    return out
+
+def _select_MOs(qc, MO_list, spin):
+    u"""Keeps in qc.mo_spec the orbitals of MO_list (see MO) of the given spin."""
     ## Get list of orbitals
     ## In the 1.1 version of orbkit, for unrestricted calculations, both alpha and beta orbitals are mixed in the same array !
     if spin == "none":
@@ -107,13 +402,95 @@ def MO(j_data, MO_list, spin="none", grid_step=obk_step, nproc=4):
     else:
         print("Unknown spin detected. Treated as a restricted calculation!")
         qc.mo_spec = qc.mo_spec.select(MO_list)
-        
-    
 
-    ## Calculate
-    out = core.rho_compute(qc, calc_mo=True, numproc=nproc)
+## Calculations
+def MO(j_data, MO_list, spin="none", grid_step=obk_step, nproc=4, sparse=False, settings=None):
+    u"""Calculates the voxels representing the requested molecular orbitals of a molecule.
 
-    return out, X, Y, Z
+    ** Parameters **
+      j_data : dict
+    Data on the molecule, deserialized from the scanlog format.
+      MO_list : list(str) or list(int)
+    A list containing either:
+      - integers designating the molecular orbitals (starting from 1)
+      - strings designating the molecular orbitals either through:
+        - keywords (e.g. "homo", "lumo")
+        - ranges (e.g. "homo-1:lumo+2")
+        - symmetries (e.g. "5.A")
+      grid_step : int, optional
+    Governs the grid to be used for the voxels.
+      - If positive, it indicates the number of points in all 3 dimensions.
+      - If zero, it indicates the default number of points (80).
+      - If negative, it indicates the resolution, in (A.U.)^-1.
+      sparse : bool, optional
+    If True and the MOs are screened (screen_threshold), they are returned as sparse_grid.BlockGrid.
+      settings : Settings, optional
+    Settings of the discretization.
+
+    ** Returns **
+      out : list(numpy.ndarray)
+    List of numpy.ndarrays, each one containing the values of the probability amplitude of a single molecular orbital at each voxel of the grid.
+    The arrays may be shared with the MO cache (settings.mo_cache) and are read only.
+      grid : Grid
+    Descriptor of the grid required for positioning the voxel values contained in out.
+    """
+
+    if settings is None:
+        settings = Settings()
+    mo_cache, grid_store, grid_dtype = settings.mo_cache, settings.grid_store, settings.grid_dtype
+
+    ## Prepare data for ORBKIT
+    qc = json2orbkit.convert_json(j_data, all_mo=True)
+    grid = _init_ORB_grid(qc, grid_step, settings.grid_padding)
+    wfn_key = (_wfn_hash(j_data, qc), _grid_spec(qc, grid_step, settings.grid_padding), np.dtype(grid_dtype).str,
+               _screening(settings))
+
+    _select_MOs(qc, MO_list, spin)
+
+    ## Calculate only the orbitals which are not in the cache
+    # keyed by the spin of the orbital, not the one requested: the MOs of a restricted
+    # wavefunction are the same for spin="none" (MO pictures) and spin="alpha" (TD)
+    keys = [wfn_key + (qc.mo_spec[i].get('spin'), qc.mo_spec[i]['sym']) for i in range(len(qc.mo_spec))]
+    out = [mo_cache.get(key) for key in keys]
+    # then in the grid store of a previous run
+    if grid_store is not None:
+        for i, key in enumerate(keys):
+            stored = grid_store.load(grid_store.key("MO", key)) if out[i] is None else None
+            if stored is not None:
+                arrays, values = stored
+                out[i] = arrays["MO"] if "MO" in arrays else \
+                         sparse_grid.BlockGrid(grid, values["block"], arrays["MO_blocks"], arrays["MO_data"])
+                mo_cache.put(key, out[i])
+    missing = [i for i, vox in enumerate(out) if vox is None]
+    if len(missing) > 0:
+        if len(missing) < len(out):
+            mo_spec = MOClass([])
+            for i in missing:
+                mo_spec.append(qc.mo_spec[i])
+            mo_spec.update()
+            qc.mo_spec = mo_spec
+        if settings.screen_threshold is None:
+            computed = core.rho_compute(qc, calc_mo=True, numproc=nproc)
+        else:
+            computed = _screened_MOs(qc, grid, settings, nproc=nproc)
+            # back to the regular grid
+            _init_ORB_grid(qc, grid_step, settings.grid_padding)
+        for i, vox in zip(missing, computed):
+            if not isinstance(vox, sparse_grid.BlockGrid):
+                vox = np.asarray(vox, dtype=grid_dtype)
+            mo_cache.put(keys[i], vox)
+            if grid_store is not None:
+                if isinstance(vox, sparse_grid.BlockGrid):
+                    grid_store.save(grid_store.key("MO", keys[i]), {"MO_blocks": vox.index, "MO_data": vox.data},
+                                    {"block": vox.block})
+                else:
+                    grid_store.save(grid_store.key("MO", keys[i]), {"MO": vox})
+            out[i] = vox
+    print("Discretized MOs: %d computed, %d from cache" % (len(missing), len(out) - len(missing)))
+    if not sparse:
+        out = [vox.dense() if isinstance(vox, sparse_grid.BlockGrid) else vox for vox in out]
+
+    return out, grid
 
 
 
@@ -178,7 +555,44 @@ def _density_difference_MOs(et_transitions):
    
     return MOs_alpha, MOs_beta
 
-def TD(config, j_data, transitions, grid_step=obk_step, nproc=4):
+def _charge_sums(vox, axes, slab=16):
+    u"""Sums the positive and negative voxels and their first moments in one pass.
+
+    The grid is traversed by slabs along x. The positive (negative) part of a slab is written
+    in a single buffer and reduced on the axes: on a regular mesh the first moments are
+    Sum(q*x) = Sum_i x_i*Sum_jk q_ijk, so no coordinate grid and no boolean mask are needed.
+    The sums of consecutive parts of a grid along x can be added.
+
+    ** Parameters **
+      vox : numpy.ndarray
+    Voxel values (3D).
+      axes : tuple(numpy.ndarray)
+    Coordinates of the voxels along x, y and z.
+      slab : int, optional
+    Number of x planes processed at once.
+
+    ** Returns **
+      q, m : numpy.ndarray
+    Sums of the positive (q[0]) and negative (q[1]) voxels, and the sums of their products with x, y and z (m[0] and m[1]).
+    The charges are q*d3r and the barycenters m/q.
+    """
+    x, y, z = axes
+    q = np.zeros(2)
+    m = np.zeros((2, 3))
+    # float64 buffer: the sums are accumulated in double precision whatever the type of vox
+    buf = np.empty((min(slab, vox.shape[0]),) + vox.shape[1:], dtype=np.float64)
+    for a in range(0, vox.shape[0], slab):
+        v = vox[a:a + slab]
+        b = buf[:len(v)]
+        for sign, clip in enumerate((np.maximum, np.minimum)):
+            clip(v, 0.0, out=b)
+            sx = b.sum(axis=(1, 2))
+            syz = b.sum(axis=0)
+            q[sign] += sx.sum()
+            m[sign] += [np.dot(x[a:a + slab], sx), np.dot(y, syz.sum(axis=1)), np.dot(z, syz.sum(axis=0))]
+    return q, m
+
+def TD(config, j_data, transitions, grid_step=obk_step, nproc=4, settings=None):
     u"""Calculates diverse data on the requested transitions of a molecule.
 
     ** Parameters **
@@ -191,6 +605,8 @@ def TD(config, j_data, transitions, grid_step=obk_step, nproc=4):
       - If positive, it indicates the number of points in all 3 dimensions.
       - If zero, it indicates the default number of points (80).
       - If negative, it indicates the resolution, in Á^-1.
+      settings : Settings, optional
+    Settings of the discretization.
 
     ** Returns ** 
       out: list(tuple)
@@ -205,109 +621,393 @@ def TD(config, j_data, transitions, grid_step=obk_step, nproc=4):
      - sequences of voxels representing the overlap between the initial and final MOs;
      - A tuple containing:
        - The positions of the positive and negative barycenters, respectively, in atomic coordinates positions (usually angstrom)
-     X, Y, Z : numpy.ndarray
-    Meshgrids (as generated by numpy.mgrid), required for placing the voxels contained in out.
+     grid : Grid
+    Descriptor of the grid, required for placing the voxels contained in out.
     """
     verbose = config.output.verbosity
+    if settings is None:
+        settings = Settings()
+    grid_store, grid_dtype = settings.grid_store, settings.grid_dtype
+
+    ## Results of a previous run
+    if grid_store is not None:
+        qc = json2orbkit.convert_json(j_data, all_mo=True)
+        key = _input_key(settings, j_data, qc, "TD", transitions, grid_step)
+        stored = grid_store.load(key)
+        if stored is not None:
+            print("Density differences reloaded from", grid_store.path)
+            grid = _init_ORB_grid(qc, grid_step, settings.grid_padding)
+            arrays, values = stored
+            out = []
+            for i, (tozer, ct, o_dip) in enumerate(values["results"]):
+                D, Qctp, Mu, Pp, Pn = ct
+                out += [(arrays["vox_data_%d" % i], tozer, (D, Qctp, Mu, np.array(Pp), np.array(Pn)),
+                         arrays["vox_Oif_%d" % i], (np.array(o_dip[0]), np.array(o_dip[1])))]
+            return out, grid
 
     ## To save time, the calculation is done in two phases:
 
     ## 1. Get all MOs involved in transitions and calculate them once
     MO_list_alpha, MO_list_beta = _density_difference_MOs(transitions)
+
+    # grids larger than the memory budget are calculated slab by slab
+    if _use_slabs(settings, j_data, len(MO_list_alpha) + len(MO_list_beta), len(transitions), grid_step):
+        try:
+            return _TD_slabs(config, j_data, transitions, MO_list_alpha, MO_list_beta, settings,
+                             grid_step=grid_step, nproc=nproc)
+        finally:
+            # the memory maps returned keep the data of the removed spill files
+            if settings.grid_store is None:
+                shutil.rmtree(_spill_path, ignore_errors=True)
     
     # Treat alpha orbitals
-    MOs_alpha, X, Y, Z = MO(j_data, MO_list_alpha, spin="alpha", grid_step=grid_step, nproc=nproc)
+    MOs_alpha, grid = MO(j_data, MO_list_alpha, spin="alpha", grid_step=grid_step, nproc=nproc, settings=settings)
     # Treat beta orbitals 
     if len(MO_list_beta) > 0:
-        MOs_beta, X, Y, Z = MO(j_data, MO_list_beta, spin="beta", grid_step=grid_step, nproc=nproc)
+        MOs_beta, grid = MO(j_data, MO_list_beta, spin="beta", grid_step=grid_step, nproc=nproc, settings=settings)
     
-    dx, dy, dz = (X[10,0,0] - X[9,0,0]), (Y[0,10,0] - Y[0,9,0]), (Z[0,0,10] - Z[0,0,9])
-    d3r = dx*dy*dz
+    d3r = grid.d3r
     print("Element of volume :", d3r)
 
     ## 2. Combine MOs according to info in `et_transitions`
+    # Stack of the discretized orbitals
+    orbitals = [np.ravel(mo) for mo in MOs_alpha]
+    if len(MO_list_beta) > 0:
+        orbitals += [np.ravel(mo) for mo in MOs_beta]
+    orb_index = _orbital_index(MO_list_alpha, MO_list_beta)
+    shape, nvox = MOs_alpha[0].shape, orbitals[0].size
+
+    vox_all = np.empty((len(transitions), nvox), dtype=grid_dtype)
+    oif_all = np.zeros((len(transitions), nvox), dtype=grid_dtype)
+    tozer = np.zeros(len(transitions))
+    _combine_MOs(transitions, _transition_weights(transitions, orb_index, len(orbitals), grid_dtype), orbitals, orb_index, d3r,
+                 vox_all, oif_all, tozer, verbose)
+
+    # the grid is a regular mesh: 1-D axes are enough for the barycenters
+    axes = grid.axes
     out = []
     for i, T in enumerate(transitions):
-        vox_data = np.zeros(MOs_alpha[0].shape)
-        vox_Oif = np.zeros(MOs_alpha[0].shape)      
-        tozer = 0
+        vox_data, vox_Oif = vox_all[i].reshape(shape), oif_all[i].reshape(shape)
+        out += [_transition_results(vox_data, tozer[i], _charge_sums(vox_data, axes),
+                                    vox_Oif, _charge_sums(vox_Oif, axes), grid)]
+
+    if grid_store is not None:
+        arrays, results = {}, []
+        for i, (vox_data, tozer, ct, vox_Oif, o_dip) in enumerate(out):
+            arrays["vox_data_%d" % i], arrays["vox_Oif_%d" % i] = vox_data, vox_Oif
+            results.append([tozer, ct, o_dip])
+        grid_store.save(key, arrays, {"results": results})
+
+    return out, grid
+
+def _orbital_index(MO_list_alpha, MO_list_beta):
+    u"""Returns the function giving the position of an orbital (MO, spin) of a transition in the stack of the alpha then beta orbitals."""
+    index = {(mo, 0): k for k, mo in enumerate(MO_list_alpha)}
+    index.update({(mo, 1): len(MO_list_alpha) + k for k, mo in enumerate(MO_list_beta)})
+    def orb_index(mo):
+        if mo[1] not in (0, 1):
+            print("Unrecognised spin in TD transition")
+            # treat by default as alpha orbital
+            return index[(mo[0], 0)]
+        return index[(mo[0], mo[1])]
+    return orb_index
+
+def _transition_weights(transitions, orb_index, n_orbitals, dtype=np.float64):
+    u"""Weights of the squared orbitals in the density differences.
+
+    Dp_i = S_j(C_ij**2*(MO2_ij**2 - MO1_ij**2)) for all the transitions with one product:
+    weights[i, k] = sum of the C_ij**2 of the orbital k (ending +, starting -) in the transition i
+    """
+    weights = np.zeros((len(transitions), n_orbitals), dtype=dtype)
+    for i, T in enumerate(transitions):
+        for subtrans in T:
+            c2 = subtrans[2]**2
+            weights[i, orb_index(subtrans[1])] += c2
+            weights[i, orb_index(subtrans[0])] -= c2
+    return weights
+
+def _combine_MOs(transitions, weights, orbitals, orb_index, d3r, vox_data, vox_Oif, tozer, verbose=False):
+    u"""Combines the discretized orbitals of a set of voxels (the whole grid or a slab) for all the transitions.
+
+    ** Parameters **
+      weights : numpy.ndarray
+    See _transition_weights.
+      orbitals : list(numpy.ndarray)
+    Flat orbitals on the voxels, in the order of orb_index.
+      vox_data, vox_Oif : numpy.ndarray
+    Output density differences and overlaps, shape (ntransitions, nvoxels). vox_Oif must be zeroed.
+      tozer : numpy.ndarray
+    Tozer lambda of the transitions, accumulated (float64).
+    """
+    nvox = orbitals[0].size
+    # squares of the orbitals by blocks of voxels, so that only a block is allocated
+    block = max(1, min(nvox, TD_block // len(orbitals)))
+    squares = np.empty((len(orbitals), block), dtype=vox_data.dtype)
+    for a in range(0, nvox, block):
+        b = min(a + block, nvox)
+        for k, mo in enumerate(orbitals):
+            np.square(mo[a:b], out=squares[k, :b - a])
+        np.matmul(weights, squares[:, :b - a], out=vox_data[:, a:b])
+    del squares
+
+    scratch = np.empty(nvox, dtype=vox_data.dtype)
+    for i, T in enumerate(transitions):
         for j, subtrans in enumerate(T):
-            #print("Processing Subtransition: ", subtrans)
             if verbose :
                 print("Calculating transition {}.{}".format(i, j))
             elif i==0 and j==0:
                 print("Calculating transitions...")
-            ## Dp_i = S_j(C_ij**2*(MO2_ij**2 - MO1_ij**2))
-            #print("Starting MO is ", ST[0][0] , "and index in MOs after discretization " ,  MOs_alpha.index(ST[0][0]))
-            #print("Ending MO is ", ST[1][0] , "and index in MOs after discretization " ,  MOs_alpha.index(ST[1][0]))
-            # Test spin of starting  orbital
-            if subtrans[0][1] == 0:
-                # alpha orbital
-                MO_start = MOs_alpha[MO_list_alpha.index(subtrans[0][0])]
-            elif subtrans[0][1] == 1:
-                MO_start = MOs_beta[MO_list_beta.index(subtrans[0][0])]
-            else :
-                print("Unrecognised spin in TD transition")
-                # treat by default as alpha orbital
-                MO_start = MOs_alpha[MO_list_alpha.index(subtrans[0][0])]
-            # Test spin of ending orbital
-            if subtrans[1][1] == 0:
-                # alpha orbital
-                MO_end = MOs_alpha[MO_list_alpha.index(subtrans[1][0])]
-            elif subtrans[1][1] == 1:
-                MO_end = MOs_beta[MO_list_beta.index(subtrans[1][0])]
-            else :
-                print("Unrecognised spin in TD transition")
-                # treat by default as alpha orbital
-                MO_end = MOs_alpha[MO_list_alpha.index(subtrans[1][0])]
-            rho_end, rho_start = np.square(MO_end), np.square(MO_start)
-            #print("Coefficient is " , ST[2])
-            vox_data += subtrans[2]**2*(rho_end - rho_start)
+            k_start, k_end = orb_index(subtrans[0]), orb_index(subtrans[1])
+            c2 = subtrans[2]**2
 
             ## For rationale of Electric dipole. 
             # Let's keep the voxel data of overlap of S_j(C_ij**2*(MO_init *MO_final))
-            vox_Oif += subtrans[2]**2*(MO_start*MO_end)*d3r
-
-            ## Tozer_i = S_j(C_ij**2*(|MO2_ij|*|MO1_ij|))
-            abs_MO_end, abs_MO_start = np.abs(MO_end), np.abs(MO_start)
-            tozer += subtrans[2]**2*np.sum(abs_MO_end*abs_MO_start)*d3r
-
-        # Separate positive P and negative voxels N and their respective positions
-        P_i, N_i = vox_data > 0.0, vox_data < 0.0
-        # positive Voxels DDp (negative DDn) in Mayavi form 
-        DDp, Xp, Yp, Zp = vox_data[P_i], X[P_i], Y[P_i], Z[P_i]
-        DDn, Xn, Yn, Zn = vox_data[N_i], X[N_i], Y[N_i], Z[N_i]
-        # Charge = sum of positive Voxels Qctp (negative Qctn) : quantity of charge transfer in e
-        Qctp, Qctn = np.sum(DDp)*d3r, np.sum(DDn)*d3r
-        # Calculation of the barycenter positions x = Sum(q_i*x_i)/Q. Mayavi center the voxel position. dx/2.0 realign with atomic coordinates
-        # Beware if atomic positions in Angstrom.  
-        Pp = np.array([np.sum(DDp*Xp)*d3r/Qctp + dx/2.0, np.sum(DDp*Yp)*d3r/Qctp + dy/2.0, np.sum(DDp*Zp)*d3r/Qctp + dz/2.0])
-        Pn = np.array([np.sum(DDn*Xn)*d3r/Qctn + dx/2.0, np.sum(DDn*Yn)*d3r/Qctn + dy/2.0, np.sum(DDn*Zn)*d3r/Qctn + dz/2.0])
-        # Charge transfer dipole norm in angstrom  
-        D = np.sqrt(np.sum(np.square(Pp - Pn)))
-        # Charge transfer dipole moment in Debye = 0.2081943 e.A  
-        Mu = D*Qctp*eA_to_D
-        
-        # transition phase dipole based on the overlap between intial and final wavefunctions
-        # Separate positive P and negative overlap voxels N and their respective positions
-        P_o, N_o = vox_Oif > 0.0, vox_Oif < 0.0
-        # positive Voxels Op (negative On) in Mayavi form 
-        Op, Xp, Yp, Zp = vox_Oif[P_o], X[P_o], Y[P_o], Z[P_o]
-        On, Xn, Yn, Zn = vox_Oif[N_o], X[N_o], Y[N_o], Z[N_o]
-        # Charge = sum of positive Voxels Qop (negative Qon) : quantity of overlap
-        Qop, Qon = np.sum(Op)*d3r, np.sum(On)*d3r
-        # Calculation of the barycenter positions x = Sum(q_i*x_i)/Q. Mayavi center the voxel position. dx/2.0 realign with atomic coordinates
-        # Beware if atomic positions in Angstrom.  
-        POp = np.array([np.sum(Op*Xp)*d3r/Qop + dx/2.0, np.sum(Op*Yp)*d3r/Qop + dy/2.0, np.sum(Op*Zp)*d3r/Qop + dz/2.0])
-        POn = np.array([np.sum(On*Xn)*d3r/Qon + dx/2.0, np.sum(On*Yn)*d3r/Qon + dy/2.0, np.sum(On*Zn)*d3r/Qon + dz/2.0])
-              
-        out += [(vox_data, tozer, (D*pm_to_a0, Qctp, Mu, Pp, Pn), vox_Oif, (POp, POn) )]
-
-    return out, X, Y, Z
-
-
-
-def Potential(j_data, grid_step=obk_step, nproc=4):
+            np.multiply(orbitals[k_start], orbitals[k_end], out=scratch)
+            scratch *= c2*d3r
+            vox_Oif[i] += scratch
+
+            ## Tozer_i = S_j(C_ij**2*(|MO2_ij|*|MO1_ij|)) = S_j(|C_ij**2*MO1_ij*MO2_ij|)
+            np.abs(scratch, out=scratch)
+            tozer[i] += scratch.sum(dtype=np.float64)
+
+def _transition_results(vox_data, tozer, ct_sums, vox_Oif, oif_sums, grid):
+    u"""Returns the tuple of results of a transition (see TD) from the sums of _charge_sums on the density difference and the overlap."""
+    d3r = grid.d3r
+    # Mayavi center the voxel position. dx/2.0 realign with atomic coordinates
+    half_step = grid.spacing/2.0
+    # Charge = sum of positive Voxels Qctp (negative Qctn) : quantity of charge transfer in e
+    # and barycenter positions x = Sum(q_i*x_i)/Q. 
+    # Beware if atomic positions in Angstrom.  
+    q, m = ct_sums
+    Qctp, Pp, Pn = q[0]*d3r, m[0]/q[0] + half_step, m[1]/q[1] + half_step
+    # Charge transfer dipole norm in angstrom  
+    D = np.sqrt(np.sum(np.square(Pp - Pn)))
+    # Charge transfer dipole moment in Debye = 0.2081943 e.A  
+    Mu = D*Qctp*eA_to_D
+
+    # transition phase dipole based on the overlap between intial and final wavefunctions
+    # Charge = sum of positive Voxels Qop (negative Qon) : quantity of overlap, and their barycenters
+    q, m = oif_sums
+    POp, POn = m[0]/q[0] + half_step, m[1]/q[1] + half_step
+
+    return (vox_data, tozer, (D*pm_to_a0, Qctp, Mu, Pp, Pn), vox_Oif, (POp, POn))
+
+def _slab_bytes_per_plane(grid, n_mo, n_transitions, dtype):
+    # orbitals computed by orbkit (float64) and cast, density differences, overlaps and scratch of a slab,
+    # buffer of _charge_sums
+    itemsize = np.dtype(dtype).itemsize
+    return grid.shape[1]*grid.shape[2]*(8*n_mo + itemsize*(n_mo + 2*n_transitions + 1) + 8)
+
+def _use_slabs(settings, j_data, n_mo, n_transitions, grid_step=obk_step):
+    u"""True if TD is calculated slab by slab: always, never or if the estimated memory exceeds max_bytes (out_of_core)."""
+    out_of_core, max_bytes = settings.out_of_core, settings.max_bytes
+    if out_of_core in ("never", False) or (out_of_core == "auto" and max_bytes is None):
+        return False
+    if out_of_core in ("always", True):
+        return True
+    shape = _grid_shape(*_grid_bounds(json2orbkit.convert_json(j_data).geo_spec, settings.grid_padding), grid_step)
+    return bytes_per_voxel("TD", n_mo, n_transitions, settings)*int(np.prod(shape)) > max_bytes
+
+## Memory-mapped files of _TD_slabs without grid store, removed once TD returns
+_spill_path = os.path.join("temp", "spill")
+
+def _TD_slabs(config, j_data, transitions, MO_list_alpha, MO_list_beta, settings, grid_step=obk_step, nproc=4):
+    u"""Calculates TD slab by slab along x, within settings.max_bytes of memory.
+
+    The orbitals are discretized by orbkit on every slab and combined at once. The density differences and
+    overlaps are written in memory-mapped files (the entry of the grid store, or temp/spill without grid store),
+    and the charges, moments and Tozer lambda are accumulated slab after slab.
+    The MOs are neither cached nor screened.
+
+    ** Parameters and Returns **
+    See TD.
+    """
+    from orbkit import grid as obk_grid
+    verbose = config.output.verbosity
+    grid_store, grid_dtype, max_bytes = settings.grid_store, settings.grid_dtype, settings.max_bytes
+    qc = json2orbkit.convert_json(j_data, all_mo=True)
+    grid = _init_ORB_grid(qc, grid_step, settings.grid_padding)
+    d3r = grid.d3r
+    x, y, z = grid.axes
+    print("Element of volume :", d3r)
+
+    # one QCinfo per spin, with the orbitals in the order of orb_index
+    qcs = []
+    for MO_list, spin in ((MO_list_alpha, "alpha"), (MO_list_beta, "beta")):
+        if len(MO_list) > 0:
+            qc_spin = json2orbkit.convert_json(j_data, all_mo=True)
+            _select_MOs(qc_spin, MO_list, spin)
+            qcs.append(qc_spin)
+    n_mo = len(MO_list_alpha) + len(MO_list_beta)
+    orb_index = _orbital_index(MO_list_alpha, MO_list_beta)
+    weights = _transition_weights(transitions, orb_index, n_mo, grid_dtype)
+
+    budget = max_bytes if max_bytes is not None else bytes_per_voxel("TD", n_mo, len(transitions), settings)*grid.size
+    slab = int(max(1, min(grid.shape[0], budget // _slab_bytes_per_plane(grid, n_mo, len(transitions), grid_dtype))))
+    print("Out-of-core TD: %d slabs of %d planes" % (-(-grid.shape[0] // slab), slab))
+
+    store = grid_store if grid_store is not None else GridStore(_spill_path, read=False)
+    key = _input_key(settings, j_data, qc, "TD", transitions, grid_step)
+    names = ["vox_data_%d" % i for i in range(len(transitions))] + ["vox_Oif_%d" % i for i in range(len(transitions))]
+    arrays = store.create(key, names, grid.shape, grid_dtype)
+
+    plane = grid.shape[1]*grid.shape[2]
+    vox_slab = np.empty((len(transitions), slab*plane), dtype=grid_dtype)
+    oif_slab = np.empty((len(transitions), slab*plane), dtype=grid_dtype)
+    tozer = np.zeros(len(transitions))
+    sums = np.zeros((2, len(transitions), 2, 4))
+    for a in range(0, grid.shape[0], slab):
+        b = min(a + slab, grid.shape[0])
+        n = (b - a)*plane
+        orbitals = []
+        for qc_spin in qcs:
+            obk_grid.set_grid(x[a:b], y, z, is_vector=False)
+            orbitals += [np.asarray(mo, dtype=grid_dtype).ravel() for mo in core.rho_compute(qc_spin, calc_mo=True, numproc=nproc)]
+        oif_slab[:, :n] = 0
+        _combine_MOs(transitions, weights, orbitals, orb_index, d3r, vox_slab[:, :n], oif_slab[:, :n], tozer,
+                     verbose and a == 0)
+        del orbitals
+        for i in range(len(transitions)):
+            for k, (name, vox) in enumerate((("vox_data_%d", vox_slab), ("vox_Oif_%d", oif_slab))):
+                v = vox[i, :n].reshape((b - a,) + grid.shape[1:])
+                arrays[name % i][a:b] = v
+                q, m = _charge_sums(v, (x[a:b], y, z))
+                sums[k, i, :, 0] += q
+                sums[k, i, :, 1:] += m
+    del vox_slab, oif_slab
+    _init_ORB_grid(qc, grid_step, settings.grid_padding)
+
+    out = []
+    for i in range(len(transitions)):
+        out += [_transition_results(None, tozer[i], (sums[0, i, :, 0], sums[0, i, :, 1:]),
+                                    None, (sums[1, i, :, 0], sums[1, i, :, 1:]), grid)]
+    results = [[o[1], o[2], o[4]] for o in out]
+    arrays = store.commit(key, arrays, {"results": results})
+    out = [(arrays["vox_data_%d" % i], o[1], o[2], arrays["vox_Oif_%d" % i], o[4]) for i, o in enumerate(out)]
+
+    return out, grid
+
+def precision_report(config, j_data, transitions, grid_step=obk_step, nproc=4, settings=None):
+    u"""Compares the charge transfer data of TD computed with float32 grids to float64 grids.
+
+    The grid store is not used, both precisions are calculated. The MOs of each precision are cached in
+    settings.mo_cache.
+
+    ** Parameters **
+      j_data, transitions, grid_step, nproc, settings
+    As for TD.
+
+    ** Returns **
+      report : list(dict)
+    For each transition and each quantity (d_ct, q_ct, mu_ct, lambda), the float64 value and the absolute
+    and relative differences of the float32 value.
+    """
+    if settings is None:
+        settings = Settings()
+    values = {}
+    for dtype in (np.float64, np.float32):
+        out, grid = TD(config, j_data, transitions, grid_step=grid_step, nproc=nproc,
+                       settings=settings.replace(grid_dtype=dtype, grid_store=None))
+        values[dtype] = [(o[2][0], o[2][1], o[2][2], o[1]) for o in out]
+        del out
+
+    report = []
+    print("Precision report: float32 vs float64 grids")
+    print("%5s %8s %16s %12s %12s" % ("state", "quantity", "float64", "abs. diff", "rel. diff"))
+    for i, (ref, single) in enumerate(zip(values[np.float64], values[np.float32])):
+        for name, a, b in zip(("d_ct", "q_ct", "mu_ct", "lambda"), ref, single):
+            diff = abs(float(b) - float(a))
+            rel = diff/abs(a) if a != 0 else (float("inf") if diff > 0 else 0.0)
+            report.append({"state": i + 1, "quantity": name, "float64": float(a), "abs_diff": diff, "rel_diff": rel})
+            print("%5d %8s %16.8e %12.3e %12.3e" % (i + 1, name, a, diff, rel))
+    return report
+
+def _nuclear_potential(grid, geo_spec, charges, alpha, slab=4, nproc=1):
+    u"""Returns the potential of the nuclei screened by the Gaussians of their charge, Sum_i Z_i*erfc(sqrt(alpha)*r)/r,
+    on the grid (see poisson.solve).
+
+    The potential of a nucleus is zero beyond a few 1/sqrt(alpha), so it is only computed on a box around
+    the nucleus. The grid is traversed by slabs along x, shared between nproc threads (numpy releases the GIL).
+    A voxel closer than 0.0005 Bohr to a nucleus gets no contribution from it.
+
+    ** Parameters **
+      grid : Grid
+    Descriptor of the grid.
+      geo_spec : numpy.ndarray
+    Positions of the nuclei (Bohr), shape (natoms, 3).
+      charges : numpy.ndarray
+    Charges of the nuclei (atomic numbers).
+      alpha : float
+    Exponent of the Gaussians (poisson.gaussian_exponent).
+      slab : int, optional
+    Number of x planes processed at once.
+      nproc : int, optional
+    Number of threads.
+
+    ** Returns **
+      V_n : numpy.ndarray
+    The potential (float64).
+    """
+    x, y, z = grid.axes
+    cut = poisson.gaussian_cutoff/np.sqrt(alpha)
+    V_n = np.zeros(grid.shape)
+
+    def add_slab(a):
+        xs = x[a:a + slab]
+        for (xi, yi, zi), Zi in zip(geo_spec, charges):
+            if xs[0] - cut > xi or xi > xs[-1] + cut:
+                continue
+            j = slice(np.searchsorted(y, yi - cut), np.searchsorted(y, yi + cut))
+            k = slice(np.searchsorted(z, zi - cut), np.searchsorted(z, zi + cut))
+            r = np.sqrt(((xs - xi)**2)[:, None, None] + ((y[j] - yi)**2)[None, :, None] + ((z[k] - zi)**2)[None, None, :])
+            r[r < 0.0005] = np.inf
+            V_n[a:a + slab, j, k] += poisson.screened_potential(r, Zi, alpha)
+
+    with ThreadPoolExecutor(max_workers=max(1, nproc)) as pool:
+        list(pool.map(add_slab, range(0, grid.shape[0], slab)))
+    return V_n
+
+class SurfacePotential:
+    u"""Electrostatic potential of the molecule at given points, for the MEP on the density isosurface.
+
+    The potential of the nuclei screened by Gaussians is computed at the points, the remainder is interpolated
+    (cubic B-splines) in the potential of the density minus these Gaussians, solved on a coarse grid (poisson.solve).
+
+    ** Parameters **
+      geo_spec : numpy.ndarray
+    Positions of the nuclei (Bohr), shape (natoms, 3).
+      charges : numpy.ndarray
+    Charges of the nuclei (atomic numbers).
+      V_e : numpy.ndarray
+    Potential of the electron density minus the Gaussians of the nuclei on the coarse grid.
+      grid : Grid
+    Descriptor of the coarse grid.
+      coeffs : numpy.ndarray, optional
+    Cubic B-spline coefficients of V_e (scipy.ndimage.spline_filter), computed if None.
+    """
+
+    def __init__(self, geo_spec, charges, V_e, grid, coeffs=None):
+        self.geo_spec = np.asarray(geo_spec, dtype=float)
+        self.charges = np.asarray(charges, dtype=float)
+        self.V_e = V_e
+        self.grid = grid
+        self.alpha = poisson.gaussian_exponent(grid)
+        self.coeffs = coeffs if coeffs is not None else ndimage.spline_filter(V_e, order=3)
+
+    def __call__(self, points, chunk=4096):
+        u"""Returns the potential at the points (Bohr), array of shape (n, 3)."""
+        points = np.asarray(points, dtype=float).reshape((-1, 3))
+        V = np.empty(len(points))
+        for a in range(0, len(points), chunk):
+            p = points[a:a + chunk]
+            R = np.linalg.norm(p[:, None, :] - self.geo_spec[None, :, :], axis=2)
+            R[R < 0.0005] = np.inf
+            V_e = ndimage.map_coordinates(self.coeffs, ((p - self.grid.origin)/self.grid.spacing).T,
+                                          order=3, mode="nearest", prefilter=False)
+            V[a:a + chunk] = poisson.screened_potential(R, self.charges, self.alpha).sum(axis=1) - V_e
+        return V
+
+def Potential(j_data, grid_step=obk_step, nproc=4, settings=None):
     u"""Calculates the electric potential difference for the molecule.
 
     ** Parameters **
@@ -318,99 +1018,78 @@ def Potential(j_data, grid_step=obk_step, nproc=4):
       - If positive, it indicates the number of points in all 3 dimensions.
       - If zero, it indicates the default number of points (80).
       - If negative, it indicates the resolution, in Á^-1.
+      settings : Settings, optional
+    Settings of the discretization.
 
     ** Returns **
       rho : numpy.ndarray
     The voxels containing the scalar values of the density.
-      V : numpy.ndarray
-    The voxels containing the scalar values of the potential.
-      X, Y, Z : numpy.ndarray
-    Meshgrids (as generated by numpy.mgrid), required for placing the voxels contained in rho and V.
+      V : numpy.ndarray|SurfacePotential
+    The voxels containing the scalar values of the potential, or in surface mode (settings.mep_mode)
+    the function returning the potential at the points of the isosurface of rho.
+      grid : Grid
+    Descriptor of the grid, required for placing the voxels contained in rho and V.
     """
 
+    if settings is None:
+        settings = Settings()
+    grid_store, mep_mode = settings.grid_store, settings.mep_mode
+
     qc = json2orbkit.convert_json(j_data)
 
-    X, Y, Z = _init_ORB_grid(qc, grid_step=grid_step)
-    dx, dy, dz = (X[10,0,0] - X[9,0,0]), (Y[0,10,0] - Y[0,9,0]), (Z[0,0,10] - Z[0,0,9])
-    d3r = dx*dy*dz
+    grid = _init_ORB_grid(qc, grid_step, settings.grid_padding)
+    d3r = grid.d3r
+
+    charges = qc.geo_info[:, -1].astype(float)
+
+    ## Results of a previous run
+    if grid_store is not None:
+        key = input_key(j_data, "MEP", grid_step=grid_step, settings=settings)
+        stored = grid_store.load(key)
+        if stored is not None:
+            print("Electrostatic potential reloaded from", grid_store.path)
+            arrays, values = stored
+            if mep_mode == "surface":
+                coarse = Grid(values["origin"], values["spacing"], arrays["V_e"].shape)
+                return arrays["rho"], SurfacePotential(qc.geo_spec, charges, arrays["V_e"], coarse), grid
+            return arrays["rho"], arrays["V"], grid
 
     rho = core.rho_compute(qc, numproc=nproc)
     # Test renormalization of rho to account for disctretization errors 
     # Get expected number of electron
     nb_e = np.sum(j_data['molecule']['atoms_Z'])-j_data['molecule']['charge']
-    rho_n = (nb_e * rho) / (np.sum(rho)*d3r)
-    rho = rho_n
-    
-    P = np.array([X, Y, Z])
-
-    ## The potential can be separated into two terms
+    rho *= nb_e / (np.sum(rho)*d3r)
+
+    ## Surface MEP: V_e on a coarse grid, V is evaluated at the points of the isosurface by the visualization
+    if mep_mode == "surface":
+        rho_c, coarse = poisson.coarsen(rho, grid, settings.mep_coarsening)
+        print("Electrostatic potential solved on the coarse grid", coarse)
+        V_e = poisson.solve(rho_c, coarse, qc.geo_spec, charges, workers=nproc)
+        del rho_c
+        if grid_store is not None:
+            grid_store.save(key, {"rho": rho, "V_e": V_e}, {"origin": coarse.origin, "spacing": coarse.spacing})
+        return rho, SurfacePotential(qc.geo_spec, charges, V_e, coarse), grid
+
+    ## The potential can be separated into two terms, a Gaussian of the charge of every nucleus
+    ## being moved from the first one to the second one
     ## V_n, the contribution from nuclear charges (positive)
-    # Sum over all nucleus i of Zi (atomic number) / the distance to the nucleus. 
-    V_n = np.zeros(rho.shape)
-    for i in range(len(qc.geo_spec)):
-        ## This currently works by:
-        ## 1. reshaping the atom position triplet to the shape of the meshgrids
-        ## 2. calculating the norm accross the three dimensions
-        ## 3. propagating the meshgrid shape to the charge
-        R = np.linalg.norm(P - qc.geo_spec[i].reshape((3,1,1,1)), axis=0)
-        R[R < 0.0005] = np.inf
-        N_i = float(qc.geo_info[i,-1])/R
-        V_n += N_i
-
-    ## V_r, the contribution from the electron density (negative)
+    # Sum over all nucleus i of Zi (atomic number) * erfc(sqrt(alpha)*r) / the distance to the nucleus:
+    # short range, only computed around the nuclei
+    V_n = _nuclear_potential(grid, qc.geo_spec, charges, poisson.gaussian_exponent(grid), nproc=nproc)
+
+    ## V_e, the contribution from the electron density minus the Gaussians (negative)
     #  Integral of density x the element of volume / the distance to the electronic density voxel
-    ## To avoid calculating the full volume integral,
-    ## we consider rho as a kernel and apply it to
-    ## the grid of inverse distances as though it were an image
-
-    ## 1. Accumulate local potential
-    V_e = np.ones(rho.shape)*rho
-
-    ## Reverse rho, so that it is traversed in the
-    ## same direction as the image matrix
-    #rho_r = rho[::-1,::-1,::-1].copy()
-
-    ## 2. Extension of the grid needed for convolution to a size of 2X-1, 2Y-1, 2Z-1 
-    # You can impose the number of voxels with mgrid if the last argument is a complex
-    # It is a solution chosen due to missing voxels on one direction in some cases
-    TIx, TIy, TIz = rho.shape
-    X_, Y_, Z_ = np.mgrid[ np.around(dx*(1 - TIx)) : np.around(dx*TIx): np.complex(TIx*2-1),
-                           np.around(dy*(1 - TIy)) : np.around(dy*TIy) : np.complex(TIy*2-1),
-                           np.around(dz*(1 - TIz)) : np.around(dz*TIz) : np.complex(TIz*2-1) ]
-#    from orbkit import grid
-#    X_, Y_, Z_ = np.mgrid[grid.min_[0] *2 : grid.max_[0] *2 : dx, 
-#                          grid.min_[1] *2 : grid.max_[1] *2 : dy, 
-#                          grid.min_[2] *2 : grid.max_[2] *2 : dz]
-    
+    ## It is the solution of the Poisson equation on the grid (see poisson.py),
+    ## which needs about 2 grids besides rho instead of the 2X-1, 2Y-1, 2Z-1 distance grid of a convolution
+    V_e = poisson.solve(rho, grid, qc.geo_spec, charges, workers=nproc)
+    V = np.subtract(V_n, V_e, out=V_e)
 
-    ## 3. Calculate distance grid
-    D = np.linalg.norm(np.array([0,0,0]).reshape((3,1,1,1)) - np.array([X_,Y_,Z_]), axis=0)
-    D[TIx - 1, TIy - 1, TIz - 1] = np.inf
-    R = 1/D
-    #print("R shape", R.shape)
-
-    ## 4. Convolute
-    ## Classic approach. 
-#    for i in range(TIx):
-#        ie = i + TIx
-#        for j in range(TIy):
-#            je = j + TIy
-#            for k in range(TIz):
-#                V_e_bis[i,j,k] += (rho_r * R[i:ie, j:je, k:k + TIz]).sum()
-
-    # Tested with H2O to produce the same array as fftconvolve wich is MUCH MUCH faster
-    # np.sum(diff_V) / np.sum(V_e_bis) = -1.30e-16
-    # np.max(diff_V) = 0.0009765625
-    # np.mean(diff_V) = -1.3840765855904132e-08
-
-    from scipy import signal as sg
-    V_e += sg.fftconvolve(R, rho, "valid")
-    V_e *= d3r
-    
+    if grid_store is not None:
+        grid_store.save(key, {"rho": rho, "V": V})
 
-    return rho, V_n - V_e, X, Y, Z
+    return rho, V, grid
 
-def Fukui(j_data_opt, j_data_sp, label=None, grid_step=obk_step, nproc=4):
+def Fukui(j_data_opt, j_data_sp, label=None, grid_step=obk_step, nproc=4, settings=None):
     u"""Calculates the density differences/Fukui functions of the molecule.
 
     ** Parameters **
@@ -423,23 +1102,29 @@ def Fukui(j_data_opt, j_data_sp, label=None, grid_step=obk_step, nproc=4):
       - If positive, it indicates the number of points in all 3 dimensions.
       - If zero, it indicates the default number of points (80).
       - If negative, it indicates the resolution, in Á^-1.
+      settings : Settings, optional
+    Settings of the discretization.
 
          ** Returns **
            rho : numpy.ndarray
          The voxels containing the scalar values of the density.
            V : numpy.ndarray
          The voxels containing the scalar values of the potential.
-           X, Y, Z : numpy.ndarray
-         Meshgrids (as generated by numpy.mgrid), required for placing the voxels contained in rho and V.
+           grid : Grid
+         Descriptor of the grid, required for placing the voxels contained in rho and V.
         """
 
+    if settings is None:
+        settings = Settings()
+    grid_dtype = settings.grid_dtype
+
     qc_opt = json2orbkit.convert_json(j_data_opt)
     qc_sp = json2orbkit.convert_json(j_data_sp)
 
-    X, Y, Z = _init_ORB_grid(qc_opt, grid_step=grid_step)
+    grid = _init_ORB_grid(qc_opt, grid_step, settings.grid_padding)
 
-    dx, dy, dz = (X[10,0,0] - X[9,0,0]), (Y[0,10,0] - Y[0,9,0]), (Z[0,0,10] - Z[0,0,9])
-    d3r = dx*dy*dz
+    dx, dy, dz = grid.spacing
+    d3r = grid.d3r
 
     rho_opt = core.rho_compute(qc_opt, numproc=nproc)
     rho_sp = core.rho_compute(qc_sp, numproc=nproc)
@@ -450,30 +1135,31 @@ def Fukui(j_data_opt, j_data_sp, label=None, grid_step=obk_step, nproc=4):
     ## For f+ we should have density of anion - density of ground state (charge_diff = 0 --1)
     ## For f- we should have density of ground state - density of cation (charge_diff = 0 -+1)   
     if charge_diff > 0 :
-        delta_rho = np.subtract(rho_sp, rho_opt)
+        delta_rho = np.subtract(rho_sp, rho_opt, dtype=grid_dtype)
     elif  charge_diff < 0 :
-        delta_rho = np.subtract(rho_opt, rho_sp)
+        delta_rho = np.subtract(rho_opt, rho_sp, dtype=grid_dtype)
 
 
     print("Rho : ", np.sum(rho_opt)*d3r, "(", np.min(rho_opt)," ... ", np.max(rho_opt),")")
     print("d : ", dx, dy, dz)
-    print("P0 : ", X[0,0,0], Y[0,0,0], Z[0,0,0])
-    print("P1 : ", X[-1,0,0], Y[0,-1,0], Z[0,0,-1])
-    P = np.array([X, Y, Z])
+    print("P0 : ", *grid.origin)
+    print("P1 : ", *[a[-1] for a in grid.axes])
 
-    return delta_rho, X, Y, Z
+    return delta_rho, grid
 
 
-def Fdual(j_data_opt, delta_rho_plus, delta_rho_minus, grid_step=obk_step):
+def Fdual(j_data_opt, delta_rho_plus, delta_rho_minus, grid_step=obk_step, settings=None):
 
+    if settings is None:
+        settings = Settings()
     qc_opt = json2orbkit.convert_json(j_data_opt)
     #qc_spplus = json2orbkit.convert_json(j_data_spplus)
     #qc_spminus = json2orbkit.convert_json(j_data_spminus)
 
-    X, Y, Z = _init_ORB_grid(qc_opt, grid_step=grid_step)
+    grid = _init_ORB_grid(qc_opt, grid_step, settings.grid_padding)
 
-    dx, dy, dz = (X[10,0,0] - X[9,0,0]), (Y[0,10,0] - Y[0,9,0]), (Z[0,0,10] - Z[0,0,9])
-    d3r = dx*dy*dz
+    dx, dy, dz = grid.spacing
+    d3r = grid.d3r
 
     #rho_opt = core.rho_compute(qc_opt, numproc=4)
     #rho_spplus = core.rho_compute(qc_spplus, numproc=4)
@@ -485,11 +1171,9 @@ def Fdual(j_data_opt, delta_rho_plus, delta_rho_minus, grid_step=obk_step):
 
     #print("Rho : ", np.sum(rho_opt)*d3r, "(", np.min(rho_opt)," ... ", np.max(rho_opt),")")
     #print("d : ", dx, dy, dz)
-    #print("P0 : ", X[0,0,0], Y[0,0,0], Z[0,0,0])
-    #print("P1 : ", X[-1,0,0], Y[0,-1,0], Z[0,0,-1])
-    P = np.array([X, Y, Z])
+    #print("P0 : ", *grid.origin)
 
-    return delta_rho_2, X, Y, Z 
+    return delta_rho_2, grid
 
 
 def CDFT_plus_Indices(j_data_opt, j_data_spplus):
@@ -0,0 +1,177 @@
+## -*- encoding: utf-8 -*-
+
+## On-disk store of the discretized grids (MO, EDD, overlaps, MEP).
+# Every entry is a directory named by the hash of its inputs (wavefunction,
+# grid parameters, transitions...) holding one .npy file per array and a JSON
+# file for the scalar results. Arrays are reloaded memory-mapped on restart.
+# A manifest records the input key of every rendered image, so that only the
+# images whose inputs changed are rendered again.
+# Above max_size, the least recently used entries are evicted (the mtime of
+# values.json is the LRU clock), except those pinned while other processes
+# still have to read their files (see render_queue).
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from collections import Counter
+
+class GridStore:
+    u"""Persistent store of voxel grids.
+
+    **Parameters:**
+      path : str
+    Directory of the store (created if needed).
+      read : bool
+    If False, the entries are only written (full process), else they are reloaded (restart).
+      max_size : int|float, optional
+    Maximal size of the store in MB. The least recently used entries are evicted above. None: no limit.
+    """
+
+    manifest_name = "images.json"
+
+    def __init__(self, path, read=True, max_size=None):
+        self.path = path
+        self.read = read
+        self.max_size = int(max_size * 1e6) if max_size is not None else None
+        self.pinned = Counter()
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest_file = os.path.join(self.path, self.manifest_name)
+        try:
+            with open(self.manifest_file) as fd:
+                self.manifest = json.load(fd)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    @staticmethod
+    def key(*parts):
+        u"""Returns the key of an entry from its inputs (str, numbers, nested lists or numpy arrays)."""
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                h.update(json.dumps(part, default=lambda o: np.asarray(o).tolist()).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def load(self, key):
+        u"""Returns (arrays, values) stored for key, arrays being memory-mapped, or None."""
+        if not self.read:
+            return None
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "values.json")) as fd:
+                values = json.load(fd)
+            arrays = {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+                      for name in values.pop("_arrays")}
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(os.path.join(entry, "values.json"))
+        except OSError:
+            pass
+        return arrays, values
+
+    def save(self, key, arrays, values=None):
+        u"""Stores the dict of numpy arrays and the dict of JSON serializable values for key."""
+        tmp = self._tmp(key)
+        os.makedirs(tmp, exist_ok=True)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), a)
+        self._commit(key, sorted(arrays), values)
+
+    def create(self, key, names, shape, dtype):
+        u"""Returns writable memory-mapped arrays (dict name: array) of a new entry, which is stored by commit."""
+        tmp = self._tmp(key)
+        os.makedirs(tmp, exist_ok=True)
+        return {name: np.lib.format.open_memmap(os.path.join(tmp, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+                for name in names}
+
+    def commit(self, key, arrays, values=None):
+        u"""Stores the entry created by create once its arrays are written, and returns them reloaded read only."""
+        for a in arrays.values():
+            a.flush()
+        names = sorted(arrays)
+        arrays.clear()
+        self._commit(key, names, values)
+        entry = self._entry(key)
+        return {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r") for name in names}
+
+    def _tmp(self, key):
+        return "%s.%d.tmp" % (self._entry(key), os.getpid())
+
+    def _commit(self, key, names, values):
+        entry, tmp = self._entry(key), self._tmp(key)
+        values = dict(values or {})
+        values["_arrays"] = names
+        # written last: an entry without values.json is incomplete
+        with open(os.path.join(tmp, "values.json"), "w") as fd:
+            json.dump(values, fd, default=lambda o: np.asarray(o).tolist())
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict(keep=key)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = self._entry(name)
+            if name.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            try:
+                mtime = os.stat(os.path.join(entry, "values.json")).st_mtime
+                size = sum(os.stat(os.path.join(entry, f)).st_size for f in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((mtime, size, name))
+        return entries
+
+    def pin(self, path):
+        u"""Keeps the entry of the file path from eviction until unpin(path). Returns False if path is not in the store."""
+        entry = os.path.dirname(os.path.abspath(path))
+        if os.path.dirname(entry) != os.path.abspath(self.path):
+            return False
+        self.pinned[os.path.basename(entry)] += 1
+        return True
+
+    def unpin(self, path):
+        u"""Releases a pin of pin(path)."""
+        name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        self.pinned[name] -= 1
+        if self.pinned[name] <= 0:
+            del self.pinned[name]
+
+    def evict(self, keep=None):
+        u"""Removes the least recently used entries (except keep and the pinned ones) until the store fits in max_size.
+
+        The arrays memory-mapped by this process stay readable (their memory maps keep the data of the removed
+        files), but the files of the entries can no longer be loaded: pin them for other processes.
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            if name == keep or name in self.pinned:
+                continue
+            shutil.rmtree(self._entry(name), ignore_errors=True)
+            total -= size
+
+    def image_current(self, image, key):
+        u"""True if the image (a label, e.g. "MO-homo") was rendered from the inputs of key."""
+        return self.read and self.manifest.get(image) == key
+
+    def record_image(self, image, key):
+        u"""Records that the image has been rendered from the inputs of key."""
+        self.manifest[image] = key
+        tmp = "%s.%d.tmp" % (self.manifest_file, os.getpid())
+        with open(tmp, "w") as fd:
+            json.dump(self.manifest, fd, indent=1)
+        os.replace(tmp, self.manifest_file)
@@ -16,6 +16,8 @@ from importlib import import_module
 from pickle import loads
 # scipy.parse for mo_coeffs in JSON
 import scipy.sparse
+# binary basis set and mo_coeffs next to the JSON
+from quchemreport.parser import sidecar
 
 def convert_json(jData, all_mo=False, spin=None):
   '''Converts a JSON data created by scanlog to an instance of
@@ -42,11 +44,19 @@ def convert_json(jData, all_mo=False, spin=None):
   qc.mo_spec = MOClass([])
   
   # Added lines to orbkit program for basis set and MO coeffs storage in JSON
-  gbasis = loads(bytes(jData['comp_details']['general']['basis_set'], 'utf-8'))
+  if 'basis_set_sidecar' in jData['comp_details']['general']:
+    gbasis = sidecar.load_basis(jData['comp_details']['general']['basis_set_sidecar'])
+  else:
+    gbasis = loads(bytes(jData['comp_details']['general']['basis_set'], 'utf-8'))
   shape = (jData['results']['wavefunction']['MO_number_kept'],jData['comp_details']['general']['basis_set_size'])
   pre_mocoeffs = jData['results']['wavefunction']['MO_coefs']
+  mo_energies = jData['results']['wavefunction']['MO_energies']
   # Detexction od MO coeffs stored as sparse matrices with tuples or dense ones.
-  if type(pre_mocoeffs[0]) is tuple:
+  if type(pre_mocoeffs[0]) is dict:
+    # references to the .npy sidecar files (memory-mapped, no copy)
+    mocoeffs = [sidecar.load_array(ref['coefs']) for ref in pre_mocoeffs]
+    mo_energies = [sidecar.load_array(ref['energies']) for ref in pre_mocoeffs]
+  elif type(pre_mocoeffs[0]) is tuple:
     # Compatible for both restricted and unrestricted cases. TODO prepare tests with sparsed restricted, sparse unrestricted..
     mocoeffs = [numpy.asarray(scipy.sparse.csr_matrix(tuple([numpy.asarray(d) for d in sp_mat]), shape=shape).todense()) for sp_mat in pre_mocoeffs]
 #    if len(jData['results']['wavefunction']['MO_energies']) == 1:
@@ -192,7 +202,7 @@ def convert_json(jData, all_mo=False, spin=None):
         occ_num = 0.0
         
       qc.mo_spec.append({'coeffs': (mocoeffs[i])[ii],
-              'energy': jData['results']['wavefunction']['MO_energies'][i][ii]*ev_to_ha,
+              'energy': mo_energies[i][ii]*ev_to_ha,
               'occ_num': occ_num,
               'sym': '%d.%s' %(sym[a],a)
               })
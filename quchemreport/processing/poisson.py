@@ -0,0 +1,230 @@
+## -*- encoding: utf-8 -*-
+
+## Electrostatic potential of a charge density discretized on a regular grid.
+# Gaussian charges (e.g. the charges of the nuclei, centered on them) are removed from the density,
+# together with a wide Gaussian of the charge which remains, centered on the center of charge: their
+# potentials are analytic. The Poisson equation Lap(V) = -4*pi*rho of the remainder, which has no charge,
+# is solved on the grid of the density in the basis of the type-I discrete sine transform. The values of V
+# on the faces of the grid are interpolated in the same solution on a coarser grid (about 0.8 Bohr) padded
+# with zeros, whose faces are far enough from the density for the multipole expansion (dipole, quadrupole)
+# of the remainder. The memory used is about 3 grids: the density, the potential and the work array of the transform.
+
+import numpy as np
+from scipy import fft
+from scipy import ndimage
+from scipy.special import erf, erfc
+
+## erfc(x) and exp(-x**2) are below 1e-11 beyond x = 5
+gaussian_cutoff = 5.0
+## Spacing (Bohr) of the grid which gives the values on the faces, and its padding (fraction of the largest edge of the grid)
+boundary_spacing = 0.8
+boundary_padding = 0.5
+
+def gaussian_exponent(grid):
+    u"""Exponent of the Gaussian charges removed from the density by solve: as narrow as the grid resolves
+    (standard deviation of 2.1 voxels)."""
+    return 1.0/(3.0*np.max(grid.spacing))**2
+
+def gaussian_potential(r, Q, alpha):
+    u"""Potential of the normalized Gaussian charge Q*(alpha/pi)**1.5*exp(-alpha*r**2) at the distances r."""
+    r = np.maximum(r, 1e-12)
+    return Q*erf(np.sqrt(alpha)*r)/r
+
+def screened_potential(r, Q, alpha):
+    u"""Potential of the point charge Q minus the one of its Gaussian (gaussian_potential): zero beyond gaussian_cutoff/sqrt(alpha)."""
+    return Q*erfc(np.sqrt(alpha)*r)/r
+
+def multipoles(rho, grid):
+    u"""Returns the charge, the center, the dipole and the traceless quadrupole of the density.
+
+    The moments are computed from the projections of rho on the xy, xz and yz planes: no coordinate grid is built.
+
+    ** Parameters **
+      rho : numpy.ndarray
+    Density (3D).
+      grid : calc_orb.Grid
+    Descriptor of the grid of rho.
+
+    ** Returns **
+      Q, center, dipole, quadrupole
+    Charge, center of charge (the dipole is zero about it unless Q is zero), dipole (3) and quadrupole (3x3),
+    with Theta_ij = Sum rho*(3*d_i*d_j - d**2*delta_ij)*d3r.
+    """
+    d3r = grid.d3r
+    axes = grid.axes
+    proj = {(0, 1): rho.sum(axis=2), (0, 2): rho.sum(axis=1), (1, 2): rho.sum(axis=0)}
+    line = [proj[(0, 1)].sum(axis=1), proj[(0, 1)].sum(axis=0), proj[(0, 2)].sum(axis=0)]
+    Q = line[0].sum()*d3r
+    first = np.array([np.dot(axes[i], line[i]) for i in range(3)])*d3r
+    center = first/Q if Q != 0 else np.array([np.mean(a) for a in axes])
+    # centered coordinates
+    d = [a - c for a, c in zip(axes, center)]
+    second = np.empty((3, 3))
+    for i in range(3):
+        second[i, i] = np.dot(d[i]**2, line[i])*d3r
+    for (i, j), p in proj.items():
+        second[i, j] = second[j, i] = d[i] @ p @ d[j]*d3r
+    dipole = np.array([np.dot(d[i], line[i]) for i in range(3)])*d3r
+    quadrupole = 3*second - np.trace(second)*np.eye(3)
+    return Q, center, dipole, quadrupole
+
+def multipole_potential(points, Q, center, dipole, quadrupole):
+    u"""Potential of the multipole expansion at the points (array of shape (..., 3))."""
+    R = points - center
+    r2 = np.einsum("...i,...i", R, R)
+    r = np.sqrt(r2)
+    V = Q/r + np.einsum("...i,i", R, dipole)/(r*r2)
+    V += 0.5*np.einsum("...i,ij,...j", R, quadrupole, R)/(r2*r2*r)
+    return V
+
+def _face_points(grid, axis, index):
+    ax = list(grid.axes)
+    ax[axis] = ax[axis][index:index + 1]
+    mesh = np.meshgrid(*ax, indexing="ij")
+    return np.stack(mesh, axis=-1)[(slice(None),)*axis + (0,)]
+
+def _add_gaussians(out, axes, centers, charges, alpha, scale):
+    u"""Adds scale*Q*(alpha/pi)**1.5*exp(-alpha*|r - c|**2) of every center to out, on the box where it is not negligible."""
+    cut = gaussian_cutoff/np.sqrt(alpha)
+    for c, Q in zip(centers, charges):
+        box = tuple(slice(np.searchsorted(a, ci - cut), np.searchsorted(a, ci + cut)) for a, ci in zip(axes, c))
+        gx, gy, gz = [np.exp(-alpha*(a[s] - ci)**2) for a, s, ci in zip(axes, box, c)]
+        gx *= scale*Q*(alpha/np.pi)**1.5
+        out[box] += gx[:, None, None]*np.multiply.outer(gy, gz)[None, :, :]
+
+def _multipole_boundary(points, Q, center, dipole, quadrupole, alpha_c):
+    u"""Potential of the remainder without any charge at the points of the faces, from its multipoles."""
+    return multipole_potential(points, 0.0, center, dipole, quadrupole) + \
+        screened_potential(np.linalg.norm(points - center, axis=-1), Q, alpha_c)
+
+def _coarse_boundary(rho, grid, centers, charges, workers):
+    u"""Returns a function giving the potential of the remainder (without the Gaussians of solve) at the points
+    of the faces, interpolated (cubic B-splines) in the solution of a coarser and padded grid."""
+    factor = max(1, int(boundary_spacing/np.max(grid.spacing)))
+    rho_c, coarse = coarsen(rho, grid, factor, pad=boundary_padding*np.max((np.array(grid.shape) - 1)*grid.spacing))
+    coeffs = ndimage.spline_filter(solve(rho_c, coarse, centers, charges, workers=workers, boundary="multipole"), order=3)
+    del rho_c
+    alpha, alpha_coarse = gaussian_exponent(grid), gaussian_exponent(coarse)
+
+    def boundary(points):
+        V = ndimage.map_coordinates(coeffs, np.moveaxis((points - coarse.origin)/coarse.spacing, -1, 0),
+                                    order=3, mode="nearest", prefilter=False)
+        # Gaussians of the coarse grid -> Gaussians of the grid
+        for c, q in zip(centers, charges):
+            r = np.linalg.norm(points - c, axis=-1)
+            V += screened_potential(r, q, alpha) - screened_potential(r, q, alpha_coarse)
+        return V
+    return boundary
+
+def solve(rho, grid, centers=(), charges=(), workers=None, boundary="coarse"):
+    u"""Returns the electrostatic potential V = Integral(rho(r')/|r-r'|) of the density, minus the potential
+    of the Gaussian charges of the centers, on the grid of the density.
+
+    With the charges of the nuclei at their positions, the potential of the molecule is the sum of the
+    screened_potential of the nuclei (short range) minus V.
+
+    ** Parameters **
+      rho : numpy.ndarray
+    Density (3D), e.g. in electrons/Bohr**3.
+      grid : calc_orb.Grid
+    Descriptor of the grid of rho. The density must be negligible on the faces of the grid.
+      centers : numpy.ndarray, optional
+    Positions of the Gaussian charges, shape (n, 3), inside the grid.
+      charges : numpy.ndarray, optional
+    Gaussian charges, of exponent gaussian_exponent(grid).
+      workers : int, optional
+    Number of threads of the sine transforms.
+      boundary : str, optional
+    Values on the faces: "coarse" (interpolated in a coarser solution, see _coarse_boundary)
+    or "multipole" (multipole expansion, for faces far from the density).
+
+    ** Returns **
+      V : numpy.ndarray
+    Potential on the grid (float64).
+    """
+    h2 = grid.spacing**2
+    alpha = gaussian_exponent(grid)
+    centers = np.asarray(centers, dtype=float).reshape((-1, 3))
+    charges = np.asarray(charges, dtype=float)
+
+    ## Moments of the remainder: those of a Gaussian are the ones of a point charge
+    Q, center, dipole, quadrupole = multipoles(rho, grid)
+    d = centers - center
+    Q -= charges.sum()
+    dipole = dipole - charges @ d
+    quadrupole = quadrupole - 3*np.einsum("a,ai,aj->ij", charges, d, d) + np.sum(charges*(d*d).sum(axis=1))*np.eye(3)
+    ## The charge which remains is a wide Gaussian at the center of charge, contained in the grid
+    half = min(min(c - a[0], a[-1] - c) for a, c in zip(grid.axes, center))
+    alpha_c = min((gaussian_cutoff/max(half, 1e-3))**2, alpha)
+
+    ## Dirichlet boundary: the potential of the remainder without any charge on the 6 faces
+    if boundary == "multipole":
+        face_potential = lambda points: _multipole_boundary(points, Q, center, dipole, quadrupole, alpha_c)
+    else:
+        remainder = _coarse_boundary(rho, grid, centers, charges, workers)
+        face_potential = lambda points: remainder(points) - gaussian_potential(np.linalg.norm(points - center, axis=-1), Q, alpha_c)
+    V = np.empty(rho.shape)
+    for axis in range(3):
+        for index in (0, rho.shape[axis] - 1):
+            V[(slice(None),)*axis + (index,)] = face_potential(_face_points(grid, axis, index))
+
+    ## Right-hand side on the interior, with the known boundary values of the stencil
+    inner = (slice(1, -1),)*3
+    axes = [a[1:-1] for a in grid.axes]
+    f = rho[inner]*(-4.0*np.pi)
+    _add_gaussians(f, axes, centers, charges, alpha, 4.0*np.pi)
+    _add_gaussians(f, axes, [center], [Q], alpha_c, 4.0*np.pi)
+    for axis in range(3):
+        lo = (slice(1, -1),)*axis + (0,) + (slice(1, -1),)*(2 - axis)
+        hi = (slice(1, -1),)*axis + (-1,) + (slice(1, -1),)*(2 - axis)
+        first = (slice(None),)*axis + (0,)
+        last = (slice(None),)*axis + (-1,)
+        f[first] -= V[lo]/h2[axis]
+        f[last] -= V[hi]/h2[axis]
+
+    ## The sine transform diagonalizes the Laplacian with homogeneous Dirichlet conditions:
+    ## spectral eigenvalues -(pi*k/L)**2, exact for the smooth remainder
+    f = fft.dstn(f, type=1, norm="ortho", overwrite_x=True, workers=workers)
+    eig = [-(np.pi*np.arange(1, m + 1)/(m + 1))**2/h2[axis] for axis, m in enumerate(f.shape)]
+    # eigenvalues plane by plane, so that they are never a full grid
+    lam_yz = eig[1][:, None] + eig[2][None, :]
+    for i in range(f.shape[0]):
+        f[i] /= lam_yz + eig[0][i]
+    V[inner] = fft.idstn(f, type=1, norm="ortho", overwrite_x=True, workers=workers)
+
+    ## Potential of the wide Gaussian, plane by plane
+    x, y, z = [a - c for a, c in zip(grid.axes, center)]
+    yz2 = np.add.outer(y**2, z**2)
+    for i in range(V.shape[0]):
+        V[i] += gaussian_potential(np.sqrt(yz2 + x[i]**2), Q, alpha_c)
+    return V
+
+def coarsen(rho, grid, factor, pad=0.0):
+    u"""Returns the density averaged on blocks of factor**3 voxels, and zero padded, with the descriptor of its grid.
+
+    The averages keep the charge of the density; the points of the coarse grid are the centers of the blocks,
+    and the voxels of the edges which do not fill a block are dropped.
+
+    ** Parameters **
+      rho : numpy.ndarray
+    Density (3D).
+      grid : calc_orb.Grid
+    Descriptor of the grid of rho.
+      factor : int
+    Number of voxels of the edge of the blocks.
+      pad : float, optional
+    Width of the zeros added on every face (Bohr). The multipole boundary of solve is then further from the density.
+
+    ** Returns **
+      rho_c, grid_c
+    """
+    n = [s//factor for s in rho.shape]
+    spacing = grid.spacing*factor
+    width = int(np.ceil(pad/np.min(spacing)))
+    rho_c = np.zeros([m + 2*width for m in n])
+    # x plane by x plane of the coarse grid: only a slab of rho is copied at once
+    for i in range(n[0]):
+        block = rho[i*factor:(i + 1)*factor, :n[1]*factor, :n[2]*factor].reshape((factor, n[1], factor, n[2], factor))
+        rho_c[width + i, width:width + n[1], width:width + n[2]] = block.mean(axis=(0, 2, 4))
+    origin = grid.origin + (factor - 1)/2.0*grid.spacing - width*spacing
+    return rho_c, type(grid)(origin, spacing, rho_c.shape)
@@ -0,0 +1,152 @@
+## -*- encoding: utf-8 -*-
+
+## Block-sparse grids of the discretized orbitals.
+# The regular grid is cut in cubic blocks of voxels. An upper bound of every MO
+# on a block is estimated from the exponents and contraction coefficients of the
+# basis functions (ao_spec) and from the distance between the block and their atoms.
+# Only the blocks where the bound passes a threshold are evaluated and stored.
+
+import numpy as np
+from orbkit.tools import l_deg, lquant
+
+class BlockGrid:
+    u"""Voxels of a regular grid stored by blocks, the voxels of the missing blocks being zero.
+
+    ** Parameters **
+      grid : calc_orb.Grid
+    Descriptor of the full grid.
+      block : int
+    Number of voxels of the edge of the (cubic) blocks.
+      index : numpy.ndarray
+    Indices (i, j, k) of the stored blocks, shape (nblocks, 3).
+      data : numpy.ndarray
+    Voxels of the stored blocks, shape (nblocks, block, block, block). The voxels of the
+    blocks on the edges of the grid which are outside of the grid are zero.
+    """
+
+    def __init__(self, grid, block, index, data):
+        self.grid = grid
+        self.block = int(block)
+        self.index = np.asarray(index, dtype=np.int32).reshape((-1, 3))
+        self.data = data
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.index.nbytes
+
+    def values(self):
+        u"""Returns the stored voxel values (1-D). The voxels which are not stored are zero."""
+        return self.data.ravel()
+
+    def _fill(self, out, lower):
+        b = self.block
+        for (i, j, k), values in zip(self.index*b - lower, self.data):
+            view = out[i:i + b, j:j + b, k:k + b]
+            view[...] = values[:view.shape[0], :view.shape[1], :view.shape[2]]
+        return out
+
+    def dense(self):
+        u"""Returns the voxels on the full grid (numpy.ndarray of shape grid.shape)."""
+        return self._fill(np.zeros(self.grid.shape, dtype=self.dtype), np.zeros(3, dtype=np.int32))
+
+    def crop(self):
+        u"""Returns the voxels on the smallest box containing the stored blocks, and the descriptor of that box.
+
+        ** Returns **
+          vox : numpy.ndarray
+        Voxels of the box.
+          grid : calc_orb.Grid
+        Descriptor of the box (same spacing as the full grid).
+        """
+        if len(self.index) == 0:
+            lower, upper = np.zeros(3, dtype=np.int32), np.ones(3, dtype=np.int32)
+        else:
+            lower = self.index.min(axis=0)*self.block
+            upper = np.minimum((self.index.max(axis=0) + 1)*self.block, self.grid.shape)
+        box = type(self.grid)(self.grid.origin + lower*self.grid.spacing, self.grid.spacing, upper - lower)
+        return self._fill(np.zeros(box.shape, dtype=self.dtype), lower), box
+
+def block_counts(grid, block):
+    u"""Number of blocks along x, y and z."""
+    return [-(-n // block) for n in grid.shape]
+
+def block_distances(grid, block, geo_spec):
+    u"""Returns the distances between every block of the grid (C order of the block indices) and every atom, shape (nblocks, natoms)."""
+    d2 = []
+    for ax, (axis, nb) in enumerate(zip(grid.axes, block_counts(grid, block))):
+        lo = axis[np.arange(nb)*block]
+        hi = axis[np.minimum((np.arange(nb) + 1)*block, len(axis)) - 1]
+        # distance to the segment [lo, hi] along the axis, 0 inside
+        d = np.maximum(np.maximum(lo[:, None] - geo_spec[None, :, ax], geo_spec[None, :, ax] - hi[:, None]), 0.0)
+        d2.append(d**2)
+    dist = np.sqrt(d2[0][:, None, None, :] + d2[1][None, :, None, :] + d2[2][None, None, :, :])
+    return dist.reshape((-1, len(geo_spec)))
+
+def shell_bounds(ao_spec, dist):
+    u"""Upper bounds of the absolute values of the contracted shells of ao_spec.
+
+    A normalized primitive of angular momentum l is bounded by N*r**l*exp(-alpha*r**2), which is
+    decreasing beyond sqrt(l/(2*alpha)); the real solid harmonics are bounded by sqrt(2l+1) times this value.
+
+    ** Parameters **
+      ao_spec : orbkit.orbitals.AOClass
+    Contracted shells (atom, type, coeffs as (exponent, coefficient) pairs).
+      dist : numpy.ndarray
+    Minimal distances between the blocks and the atoms, shape (nblocks, natoms).
+
+    ** Returns **
+    The bounds, shape (nblocks, nshells).
+    """
+    out = np.empty((dist.shape[0], len(ao_spec)))
+    for s, ao in enumerate(ao_spec):
+        l = lquant[ao['type']]
+        alpha, c = np.asarray(ao['coeffs'])[:, 0], np.asarray(ao['coeffs'])[:, 1]
+        norm = (2*alpha/np.pi)**0.75*(4*alpha)**(l/2.0)/np.sqrt(np.prod(np.arange(2*l - 1, 0, -2)))
+        r = np.maximum(dist[:, ao['atom']][:, None], np.sqrt(l/(2*alpha)))
+        out[:, s] = np.sqrt(2*l + 1)*(np.abs(c*norm)*r**l*np.exp(-alpha*r**2)).sum(axis=1)
+    return out
+
+def significant_blocks(qc, grid, block, threshold):
+    u"""Returns the blocks of the grid where the MOs of qc may pass the threshold.
+
+    ** Parameters **
+      qc : orbkit.qcinfo.QCinfo
+    Molecule (geo_spec, ao_spec and mo_spec).
+      grid : calc_orb.Grid
+    Descriptor of the grid.
+      block : int
+    Number of voxels of the edge of the blocks.
+      threshold : float
+    Absolute value of the MOs (a.u.) below which a block is not evaluated.
+
+    ** Returns **
+    Boolean array, shape (nMO, nblocks), the blocks being in C order of their indices.
+    """
+    bounds = shell_bounds(qc.ao_spec, block_distances(grid, block, np.asarray(qc.geo_spec)))
+    cartesian = not getattr(qc.ao_spec, "spherical", False)
+    ncomp = [len(ao['lxlylz']) if 'lxlylz' in ao else len(ao['lm']) if 'lm' in ao
+             else l_deg(lquant[ao['type']], cartesian_basis=cartesian) for ao in qc.ao_spec]
+    # |C| summed over the components of every shell
+    coeffs = np.abs(qc.mo_spec.get_coeffs())
+    shell_coeffs = np.add.reduceat(coeffs, np.concatenate(([0], np.cumsum(ncomp)[:-1])), axis=1)
+    return shell_coeffs @ bounds.T > threshold
+
+def block_points(grid, block, index):
+    u"""Returns the coordinates (x, y, z) of the voxels of the blocks which are inside the grid,
+    and the mask of these voxels in the (nblocks, block**3) layout of BlockGrid.data."""
+    local = np.indices((block,)*3).reshape((3, -1)).T
+    mask = np.ones((len(index), block**3), dtype=bool)
+    coords = []
+    for ax, axis in enumerate(grid.axes):
+        ijk = index[:, ax, None]*block + local[None, :, ax]
+        mask &= ijk < len(axis)
+        coords.append(ijk)
+    return [axis[ijk[mask]] for axis, ijk in zip(grid.axes, coords)], mask
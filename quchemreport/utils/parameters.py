@@ -11,9 +11,19 @@ obk_step = 0.075 # Depending on the molecule size, it should be adapted.
 # Oversizing the grid aroung the molecule in Bohr radii
 # ORBKIT uses 5 by default, tune this as required
 obk_extand = 5
+# Limits of the grid planner (calc_orb.plan_grid) for large molecules or small memory budgets:
+# coarsest spacing and smallest oversizing in Bohr radii, maximal number of voxels (computing time)
+obk_max_step = 0.25
+obk_min_extand = 3
+obk_max_voxels = 2e7
+# Part of resources.memory kept for the cache of discretized MOs (shared by MO, TD and emission)
+mo_cache_fraction = 0.25
 
 ## Gaussian broadening default parameters
 FWHM = 3000 # 3000 cm-1 for full width at half maximum of gaussian band. 
+# Band shape of the UV-visible and CD spectra: gaussian, lorentzian or voigt (pseudo-Voigt)
+lineshape = "gaussian"
+voigt_eta = 0.5 # Lorentzian fraction of the pseudo-Voigt band
 
 
 ## Mayavi parameters
@@ -43,6 +53,13 @@ azimuth_cam2 =  10
 # isosurface opacity
 surf_opacity = 1
 
+# Number of facets around the atom spheres and bond cylinders (ball and stick), at most glyph_resolution.
+# It is lowered for large molecules or small images, where the facets are not seen, and so that
+# the molecule has at most glyph_triangles triangles.
+glyph_resolution = 15
+glyph_min_resolution = 6
+glyph_triangles = 1e6
+
 colors = {"OM" : (0.4, 0, 0.235),  #For OM positive surface Tyrian purple
           "EDD" : (0.0, 0.5, 0.5),  #For Electron density difference positive surface metallic blue
           "Oif" : (0.95, 0.5, 0.0),  #For transitions wavefunctions overlap positive surface an orange
@@ -0,0 +1,194 @@
+## -*- encoding: utf-8 -*-
+
+## Offscreen rendering of the images in worker processes.
+# The viz_* functions of visu_mayavi are run by worker processes, each with its own
+# Mayavi/VTK context (and molecule scene), while the main process goes on with the discretization.
+# The voxel arrays are handed to the workers as memory-mapped .npy files: the files of the
+# grid store as they are, the arrays in memory written once in temp/render. The blocks of the
+# screened MOs (BlockGrid) and the coarse potential of the surface MEP (SurfacePotential) as well.
+# The entries of the grid store read by the pending jobs are pinned, so that they are not evicted.
+# The images which failed are reported when the queue is closed.
+
+import os
+import uuid
+import numpy as np
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from quchemreport.processing import calc_orb, sparse_grid
+from quchemreport.visualization import visu_mayavi
+
+class _Voxels:
+    u"""Reference to a voxel array saved in a .npy file, reloaded memory-mapped by the workers."""
+
+    def __init__(self, path):
+        self.path = path
+
+class _Rebuilt:
+    u"""Object rebuilt by the workers as cls(*args, **kwargs), its arrays being passed as _Voxels."""
+
+    def __init__(self, cls, *args, **kwargs):
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs
+
+def _npy_file(a):
+    u"""Returns the .npy file mapped by a (memory-mapped by numpy.load) if a is the whole array of the file, else None."""
+    path = getattr(a, "filename", None)
+    if not isinstance(a, np.memmap) or path is None or not path.endswith(".npy") or not a.flags.c_contiguous:
+        return None
+    try:
+        whole = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if whole.offset != a.offset or whole.shape != a.shape or whole.dtype != a.dtype or not whole.flags.c_contiguous:
+        return None
+    return path
+
+def _resolve(arg):
+    if isinstance(arg, _Voxels):
+        return np.load(arg.path, mmap_mode="r")
+    if isinstance(arg, _Rebuilt):
+        return arg.cls(*_resolve(arg.args), **{name: _resolve(a) for name, a in arg.kwargs.items()})
+    if isinstance(arg, (list, tuple)):
+        return type(arg)(_resolve(a) for a in arg)
+    return arg
+
+def _init_worker(settings):
+    for name, value in settings.items():
+        setattr(visu_mayavi, name, value)
+
+def _render(name, args, kwargs):
+    u"""Runs visu_mayavi.<name> in a worker, and returns once its images are written."""
+    getattr(visu_mayavi, name)(*_resolve(args), **kwargs)
+    visu_mayavi.wait_images()
+
+class RenderQueue:
+    u"""Queue of images rendered by worker processes.
+
+    **Parameters:**
+      nproc : int
+    Number of worker processes. With 0, the images are rendered at once in the calling process.
+      path : str
+    Directory of the voxel arrays handed to the workers.
+      settings : dict, optional
+    Settings of visu_mayavi (module variables, e.g. views) in this process and the workers.
+      max_pending : int, optional
+    Number of images waiting or being rendered above which submit waits (by default 2 per worker).
+      store : grid_store.GridStore, optional
+    Grid store whose files may be handed to the workers, pinned until their jobs are done.
+    """
+
+    def __init__(self, nproc=0, path=os.path.join("temp", "render"), settings=None, max_pending=None, store=None):
+        settings = dict(settings or {})
+        _init_worker(settings)
+        self.nproc = int(nproc)
+        self.path = path
+        self.store = store
+        self.max_pending = max_pending if max_pending is not None else 2*self.nproc
+        self.jobs = []
+        self.group = []
+        self.callbacks = []
+        self.failures = []
+        self.pool = None
+        if self.nproc > 0:
+            ## spawn: the workers do not inherit the VTK context or the grids of the main process
+            self.pool = ProcessPoolExecutor(max_workers=self.nproc, mp_context=get_context("spawn"),
+                                            initializer=_init_worker, initargs=(settings,))
+
+    def _file(self, a, files, pinned):
+        path = _npy_file(a)
+        if path is None:
+            os.makedirs(self.path, exist_ok=True)
+            path = os.path.join(self.path, uuid.uuid4().hex + ".npy")
+            np.save(path, a)
+            files.append(path)
+        elif self.store is not None and self.store.pin(path):
+            pinned.append(path)
+        return _Voxels(path)
+
+    def _share(self, arg, files, pinned):
+        if isinstance(arg, np.ndarray) and arg.ndim == 3:
+            return self._file(arg, files, pinned)
+        if isinstance(arg, sparse_grid.BlockGrid):
+            return _Rebuilt(sparse_grid.BlockGrid, arg.grid, arg.block, arg.index, self._file(arg.data, files, pinned))
+        if isinstance(arg, calc_orb.SurfacePotential):
+            # with the spline coefficients, not computed again by the workers
+            return _Rebuilt(calc_orb.SurfacePotential, arg.geo_spec, arg.charges, self._file(arg.V_e, files, pinned),
+                            arg.grid, coeffs=self._file(arg.coeffs, files, pinned))
+        if isinstance(arg, (list, tuple)):
+            return type(arg)(self._share(a, files, pinned) for a in arg)
+        return arg
+
+    def submit(self, name, *args, **kwargs):
+        u"""Renders the images of visu_mayavi.<name>(*args, **kwargs).
+
+        The voxel arrays (3-D numpy.ndarray, sparse_grid.BlockGrid, calc_orb.SurfacePotential, also in lists)
+        are not copied in memory by the worker.
+        """
+        if self.pool is None:
+            getattr(visu_mayavi, name)(*args, **kwargs)
+            return
+        while len(self.jobs) >= self.max_pending:
+            wait([job[0] for job in self.jobs], return_when=FIRST_COMPLETED)
+            self.poll()
+        files, pinned = [], []
+        future = self.pool.submit(_render, name, self._share(args, files, pinned), kwargs)
+        self.jobs.append((future, name, files, pinned))
+        self.group.append(future)
+
+    def then(self, callback, *args):
+        u"""Calls callback(*args) in this process once the images submitted since the previous call are saved.
+
+        The callback is not called if one of these images failed.
+        """
+        if self.pool is None:
+            visu_mayavi.wait_images()
+            callback(*args)
+            return
+        self.callbacks.append((self.group, callback, args))
+        self.group = []
+        self.poll()
+
+    def poll(self):
+        u"""Releases the finished jobs and calls the callbacks whose images are saved."""
+        for job in [job for job in self.jobs if job[0].done()]:
+            future, name, files, pinned = job
+            self.jobs.remove(job)
+            for path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            for path in pinned:
+                self.store.unpin(path)
+            if future.exception() is not None:
+                self.failures.append((name, future.exception()))
+        ready = []
+        for entry in self.callbacks:
+            if all(f.done() for f in entry[0]):
+                ready.append(entry)
+        for entry in ready:
+            self.callbacks.remove(entry)
+            futures, callback, args = entry
+            if all(f.exception() is None for f in futures):
+                callback(*args)
+
+    def close(self):
+        u"""Waits for all the images and stops the workers.
+
+        Raises RuntimeError if images failed in the workers (the first exception being its cause).
+        """
+        try:
+            if self.pool is not None:
+                wait([job[0] for job in self.jobs])
+                self.poll()
+                self.pool.shutdown()
+                self.pool = None
+            visu_mayavi.wait_images()
+        finally:
+            visu_mayavi.scene.close()
+        if len(self.failures) > 0:
+            failures, self.failures = self.failures, []
+            raise RuntimeError("Rendering failed for %d image(s): %s"
+                               % (len(failures), "; ".join("%s (%s)" % f for f in failures))) from failures[0][1]
@@ -71,9 +71,9 @@ def jobsSI(jf, job_types, nres_noES, charges, charge_ref, discret_proc, mo_viz_d
                         print("Alpha Molecular orbitals pictures already done!")
                     else:                                   
                         ## Calculations of MO
-                        out, X, Y, Z = calc_orb.MO(data_for_discretization, MO_list_alpha, spin="alpha", grid_step=step, nproc=nproc)
+                        out, grid = calc_orb.MO(data_for_discretization, MO_list_alpha, spin="alpha", grid_step=step, nproc=nproc)
                         ## Visulation of the MO
-                        visu_mayavi.viz_MO(out, X, Y, Z, data_for_discretization, file_name="img", labels=MO_labels_alpha)
+                        visu_mayavi.viz_MO(out, grid, data_for_discretization, file_name="img", labels=MO_labels_alpha)
                         mo_viz_done = True
                     # Unrestricted calculation: now treat the beta orbitals
                     MO_list_beta = [HO_ind[1]-1, HO_ind[1], HO_ind[1]+1, HO_ind[1]+2] 
@@ -83,9 +83,9 @@ def jobsSI(jf, job_types, nres_noES, charges, charge_ref, discret_proc, mo_viz_d
                         print("Beta Molecular orbitals pictures already done!")
                     else:                                   
                         ## Calculations of MO
-                        out, X, Y, Z = calc_orb.MO(data_for_discretization, MO_list_beta, spin="beta", grid_step=step, nproc=nproc)
+                        out, grid = calc_orb.MO(data_for_discretization, MO_list_beta, spin="beta", grid_step=step, nproc=nproc)
                         ## Visulation of the MO
-                        visu_mayavi.viz_MO(out, X, Y, Z, data_for_discretization, file_name="img", labels=MO_labels_beta)
+                        visu_mayavi.viz_MO(out, grid, data_for_discretization, file_name="img", labels=MO_labels_beta)
                         mo_viz_done = True
 
                 else:
@@ -95,9 +95,9 @@ def jobsSI(jf, job_types, nres_noES, charges, charge_ref, discret_proc, mo_viz_d
                         print("Molecular orbitals pictures already done!")
                     else:                                   
                         ## Calculations of MO
-                        out, X, Y, Z = calc_orb.MO(data_for_discretization, MO_list, spin="none", grid_step=step, nproc=nproc)
+                        out, grid = calc_orb.MO(data_for_discretization, MO_list, spin="none", grid_step=step, nproc=nproc)
                         ## Visulation of the MO
-                        visu_mayavi.viz_MO(out, X, Y, Z, data_for_discretization, file_name="img", labels=MO_labels)
+                        visu_mayavi.viz_MO(out, grid, data_for_discretization, file_name="img", labels=MO_labels)
                         mo_viz_done = True
 
               
@@ -169,11 +169,11 @@ def jobsSI(jf, job_types, nres_noES, charges, charge_ref, discret_proc, mo_viz_d
                     jf[i]["results"]["excited_states"]["e-_barycenter"] = ["N/A"] * len(et_energies)
                     jf[i]["results"]["excited_states"]["hole_barycenter"] = ["N/A"] * len(et_energies)
                     ## Discretization of all MO used in the transitions
-                    out, X, Y, Z = calc_orb.TD(data_for_discretization, et_transitions, grid_step=step, nproc=nproc)
+                    out, grid = calc_orb.TD(data_for_discretization, et_transitions, grid_step=step, nproc=nproc)
                     for k, transitions in enumerate(et_transitions):
                         if restart == 0 :
                             print("EDD visualization in progress for the transition(s):", k)
-                            visu_mayavi.viz_EDD([out[k][0]], X, Y, Z, data_for_discretization, et_sym[k], 
+                            visu_mayavi.viz_EDD([out[k][0]], grid, data_for_discretization, et_sym[k], 
                                                                  file_name="img", labels=[k+1])
                             if (len(et_rotats) > 0):
                                 visu_mayavi.viz_BARY([out[k][2][3:]], data_for_discretization, et_sym[k],
@@ -216,9 +216,9 @@ def jobsSI(jf, job_types, nres_noES, charges, charge_ref, discret_proc, mo_viz_d
                 if discret_proc is True :
                     print("Calculating the emission electronic density difference.")
                     ## Discretization of all MO used in the transition
-                    out, X, Y, Z = calc_orb.TD(data_for_discretization, [emi_transition], grid_step=step, nproc=nproc)
+                    out, grid = calc_orb.TD(data_for_discretization, [emi_transition], grid_step=step, nproc=nproc)
                     print("EDD visualization in progress for the transition :", emi_state)
-                    visu_mayavi.viz_EDD([out[0][0]], X, Y, Z, data_for_discretization, emi_sym, 
+                    visu_mayavi.viz_EDD([out[0][0]], grid, data_for_discretization, emi_sym, 
                                                              file_name="img-emi", labels=[emi_state])
                     if (emi_rotat != 0.0):
                         visu_mayavi.viz_BARY([out[0][2][3:]], data_for_discretization, emi_sym,
@@ -0,0 +1,39 @@
+## -*- encoding: utf-8 -*-
+
+## The MOs discretized for the MO pictures (spin "none") are reused by TD (spin "alpha")
+# for a restricted wavefunction.
+
+import os
+import types
+import pytest
+
+pytest.importorskip("cclib")
+pytest.importorskip("orbkit")
+scanlog = pytest.importorskip("quchemreport.parser.scanlog")
+calc_orb = pytest.importorskip("quchemreport.processing.calc_orb")
+
+examples = os.path.join(os.path.dirname(__file__), os.pardir, "examples")
+
+def test_td_reuses_mo_pictures(tmp_path, capsys):
+    logfiles, jf = scanlog.process_logfile(os.path.join(examples, "H2O_TD.log"),
+                                           log_storage_path=str(tmp_path), sparse=False)
+    j_data = jf[-1]
+    homo = j_data["results"]["wavefunction"]["homo_indexes"][0]
+    settings = calc_orb.Settings()
+    config = types.SimpleNamespace(output=types.SimpleNamespace(verbosity=False))
+
+    calc_orb.MO(j_data, ["homo", "lumo"], spin="none", grid_step=0.4, nproc=1, settings=settings)
+    assert "Discretized MOs: 2 computed, 0 from cache" in capsys.readouterr().out
+
+    # HOMO -> LUMO
+    calc_orb.TD(config, j_data, [[((homo, 0), (homo + 1, 0), 1.0)]], grid_step=0.4, nproc=1, settings=settings)
+    assert "Discretized MOs: 0 computed, 2 from cache" in capsys.readouterr().out
+
+def test_unrestricted_spins_are_distinct(tmp_path):
+    logfiles, jf = scanlog.process_logfile(os.path.join(examples, "H2O_OPT_unrestricted.log"),
+                                           log_storage_path=str(tmp_path), sparse=False)
+    j_data = jf[-1]
+    settings = calc_orb.Settings()
+    calc_orb.MO(j_data, [1], spin="alpha", grid_step=0.4, nproc=1, settings=settings)
+    calc_orb.MO(j_data, [1], spin="beta", grid_step=0.4, nproc=1, settings=settings)
+    assert settings.mo_cache.hits == 0
@@ -0,0 +1,49 @@
+## -*- encoding: utf-8 -*-
+
+## Regression test of scanlog.nuclear_repulsion_energy against the values of the
+# former pair by pair implementation for the H2O examples.
+
+import os
+import types
+import numpy as np
+import pytest
+
+cclib = pytest.importorskip("cclib")
+scanlog = pytest.importorskip("quchemreport.parser.scanlog")
+
+examples = os.path.join(os.path.dirname(__file__), os.pardir, "examples")
+
+## (final geometry, starting geometry) of the pair by pair implementation
+reference = {
+    "H2O_FREQ.log": (9.08784, 9.08784),
+    "H2O_OPT.log": (9.08784, 9.18928),
+    "H2O_OPT_NOpop.log": (9.10837, 9.18928),
+    "H2O_OPT_basis2.log": (9.10837, 9.18928),
+    "H2O_OPT_unrestricted.log": (7.21116, 9.18928),
+    "H2O_SPminus.log": (9.08784, 9.08784),
+    "H2O_SPplus.log": (9.08784, 9.08784),
+    "H2O_TD.log": (9.08784, 9.08784),
+    "H2O_TD_T.log": (9.08784, 9.08784),
+    "H2O_TD_cut.log": (9.08784, 9.08784),
+}
+
+def pairwise_nre(data, slice_id=-1):
+    # former implementation
+    nre = 0.0
+    for i in range(data.natom):
+        ri = np.array([float("%.5f" % k) for k in data.atomcoords[slice_id][i]])
+        for j in range(i + 1, data.natom):
+            rj = np.array([float("%.5f" % k) for k in data.atomcoords[slice_id][j]])
+            nre += data.atomnos[i] * data.atomnos[j] / np.linalg.norm(ri - rj)
+    return float("%.5f" % (nre * scanlog.CstBohr2Ang))
+
+@pytest.mark.parametrize("log", sorted(reference))
+def test_h2o_examples(log):
+    data = cclib.io.ccread(os.path.join(examples, log))
+    assert (scanlog.nuclear_repulsion_energy(data), scanlog.nuclear_repulsion_energy(data, 0)) == reference[log]
+
+def test_large_geometry():
+    rng = np.random.default_rng(0)
+    data = types.SimpleNamespace(natom=300, atomnos=rng.integers(1, 36, 300),
+                                 atomcoords=[rng.uniform(-15.0, 15.0, (300, 3))])
+    assert scanlog.nuclear_repulsion_energy(data) == pairwise_nre(data)